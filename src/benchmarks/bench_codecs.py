@@ -0,0 +1,74 @@
+"""
+Compare DequeDiskCache codecs on real CWE records.
+
+    python bench_codecs.py [path/to/cwec_v2.8.xml[.zip]]
+
+Without a path the catalogue is downloaded from SETTINGS["cwe"]["source"].
+"""
+import os
+import sys
+import time
+import zipfile
+
+baseDir = os.path.dirname(os.path.abspath(os.path.dirname(__file__)))
+sys.path.append(baseDir)
+sys.path.append(os.path.join(baseDir, 'plugins'))
+
+from utils import get_file
+from settings import SETTINGS
+from dskcodecs import available_codecs, encode_value, decode_value, train_zdict, ZlibDictionary
+from cweparser import iter_cwe_weaknesses, make_cwe_cache_item
+
+
+def open_cwe_catalogue(path=None):
+    if path is None:
+        data, response = get_file(getfile=SETTINGS["cwe"]["source"])
+        if data is None:
+            raise RuntimeError('Can not download CWE source: {0}'.format(response))
+        return data
+    if zipfile.is_zipfile(path):
+        fzip = zipfile.ZipFile(path, 'r')
+        return fzip.open(fzip.namelist()[0])
+    return open(path, 'rb')
+
+
+def load_cwe_records(path=None):
+    return [make_cwe_cache_item(cwe) for cwe in iter_cwe_weaknesses(open_cwe_catalogue(path))]
+
+
+def bench_codec(codec, records, compress_level=1, rounds=3):
+    zdict = ZlibDictionary(1, train_zdict(records[:500]), compress_level)
+    zdicts = {zdict.version: zdict}
+    best_encode = best_decode = None
+    for _ in range(rounds):
+        started = time.perf_counter()
+        encoded = [encode_value(record, codec, compress_level, zdict) for record in records]
+        encode_time = time.perf_counter() - started
+        started = time.perf_counter()
+        for value in encoded:
+            decode_value(value, zdicts)
+        decode_time = time.perf_counter() - started
+        best_encode = encode_time if best_encode is None else min(best_encode, encode_time)
+        best_decode = decode_time if best_decode is None else min(best_decode, decode_time)
+    return dict(
+        codec=codec,
+        stored_bytes=sum(len(value) for value in encoded),
+        encode_us=best_encode / len(records) * 1e6,
+        decode_us=best_decode / len(records) * 1e6)
+
+
+def main(args):
+    records = load_cwe_records(args[0] if args else None)
+    raw_bytes = sum(len(encode_value(record, 'none')) for record in records)
+    print('{0} CWE records, {1} bytes uncompressed'.format(len(records), raw_bytes))
+    print('{0:<12}{1:>14}{2:>10}{3:>14}{4:>14}'.format(
+        'codec', 'stored bytes', 'ratio', 'encode us/it', 'decode us/it'))
+    for codec in available_codecs():
+        result = bench_codec(codec, records)
+        print('{0:<12}{1:>14}{2:>10.2f}{3:>14.2f}{4:>14.2f}'.format(
+            result['codec'], result['stored_bytes'], raw_bytes / result['stored_bytes'],
+            result['encode_us'], result['decode_us']))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
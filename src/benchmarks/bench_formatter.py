@@ -0,0 +1,83 @@
+"""
+Compare reformat_vulnerability_for_output with the batch formatter.
+
+    python bench_formatter.py [rows]
+
+tests/test_formatter.py checks that both produce byte-identical output.
+"""
+import os
+import sys
+import json
+import time
+import random
+from datetime import datetime, timedelta
+
+baseDir = os.path.dirname(os.path.abspath(os.path.dirname(__file__)))
+sys.path.append(baseDir)
+
+from utils import reformat_vulnerability_for_output, reformat_vulnerabilities_for_output
+
+ACCESS = [
+    '{"vector": "NETWORK", "complexity": "LOW", "authentication": "NONE"}',
+    "{'vector': 'LOCAL', 'complexity': 'HIGH', 'authentication': 'SINGLE'}",
+    '{"vector": "NETWORK", "complexity": "MEDIUM", "authentication": null}',
+    {"vector": "ADJACENT_NETWORK", "complexity": "LOW", "authentication": "NONE"},
+    None,
+]
+IMPACT = [
+    '{"confidentiality": "PARTIAL", "integrity": "PARTIAL", "availability": "PARTIAL"}',
+    '{"confidentiality": "COMPLETE", "integrity": "NONE", "availability": "NONE"}',
+    "",
+]
+CAPEC = [
+    '{"id": "CAPEC-%d", "name": "Attack pattern %d"}' % (i, i) for i in range(50)
+]
+METADATA = ['{"npm": [], "snyk": [], "ms": [], "hacker_news": []}', '{"npm": ["lodash"]}', 'broken', None]
+TIMES = ['2018-01-%02dT10:%02d:00Z' % (day, day) for day in range(1, 29)] + ['2018-03-04 05:06:07.123+03:00']
+
+
+def make_rows(count, seed=1):
+    rnd = random.Random(seed)
+    started = datetime(2018, 1, 1)
+    rows = []
+    for i in range(count):
+        cwe = ['CWE-%d' % rnd.randint(1, 900) for _ in range(rnd.randint(0, 3))]
+        rows.append(dict(
+            id=i,
+            publushed=rnd.choice(TIMES),
+            modified=started + timedelta(minutes=i),
+            access=rnd.choice(ACCESS),
+            impact=rnd.choice(IMPACT),
+            cvss_time=rnd.choice(TIMES),
+            cvss=rnd.choice([0.0, 4.3, 5.0, 7.5, 10.0]),
+            cwe_elements=json.dumps(json.dumps(cwe)) if i % 2 else cwe,
+            cwe=cwe,
+            vulnerability_id='CVE-2018-%05d' % i,
+            description='Vulnerability number %d' % i,
+            capec_elements=rnd.sample(CAPEC, rnd.randint(0, 4)),
+            vulnerable_configuration=['cpe:2.3:a:vendor:product:%d' % i],
+            references=['https://example.org/%d' % i],
+            vector_string='AV:N/AC:L/Au:N/C:P/I:P/A:P',
+            metadata=rnd.choice(METADATA)))
+    return rows
+
+
+def main(args):
+    rows = make_rows(int(args[0]) if args else 20000)
+
+    started = time.perf_counter()
+    expected = [reformat_vulnerability_for_output(row) for row in rows]
+    legacy_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    actual = reformat_vulnerabilities_for_output(rows)
+    batch_time = time.perf_counter() - started
+
+    assert len(actual) == len(expected)
+    print('{0} rows: per-row {1:.3f} sec, batch {2:.3f} sec, x{3:.1f}'.format(
+        len(rows), legacy_time, batch_time, legacy_time / batch_time))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
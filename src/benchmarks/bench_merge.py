@@ -0,0 +1,63 @@
+"""
+Compare the list-scan merge with the hash-indexed one on cpe_list and references.
+
+    python bench_merge.py [sources] [items per source]
+"""
+import os
+import sys
+import time
+import random
+
+baseDir = os.path.dirname(os.path.abspath(os.path.dirname(__file__)))
+sys.path.append(baseDir)
+
+from utils import merge_unique_lists
+
+
+def scan_merge(*src_lists):
+    target_list = []
+    for src_list in src_lists:
+        for element in src_list:
+            if element not in target_list:
+                target_list.append(element)
+    return target_list
+
+
+def make_sources(sources, items, seed=1):
+    rnd = random.Random(seed)
+    universe = items * 2
+    cpe_lists = [
+        ['cpe:2.3:a:vendor{0}:product:{1}'.format(i % 50, i) for i in rnd.sample(range(universe), items)]
+        for _ in range(sources)]
+    references = [
+        [dict(url='https://example.org/{0}'.format(i), name=str(i), tags=['Vendor Advisory'])
+         for i in rnd.sample(range(universe), items)]
+        for _ in range(sources)]
+    return dict(cpe_list=cpe_lists, references=references)
+
+
+def best_of(merge, lists, rounds=3):
+    best = None
+    for _ in range(rounds):
+        started = time.perf_counter()
+        result = merge(*lists)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def main(args):
+    sources = int(args[0]) if args else 20
+    items = int(args[1]) if len(args) > 1 else 500
+    print('{0} sources x {1} items'.format(sources, items))
+    print('{0:<12}{1:>10}{2:>12}{3:>12}{4:>10}'.format('field', 'merged', 'scan sec', 'hash sec', 'speedup'))
+    for field, lists in make_sources(sources, items).items():
+        expected, scan_time = best_of(scan_merge, lists)
+        actual, hash_time = best_of(merge_unique_lists, lists)
+        assert expected == actual
+        print('{0:<12}{1:>10}{2:>12.4f}{3:>12.4f}{4:>10.1f}'.format(
+            field, len(actual), scan_time, hash_time, scan_time / hash_time))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
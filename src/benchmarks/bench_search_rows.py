@@ -0,0 +1,45 @@
+"""
+Compare memory of search results kept as dicts and as CVERow views.
+
+    python bench_search_rows.py [rows]
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+baseDir = os.path.dirname(os.path.abspath(os.path.dirname(__file__)))
+sys.path.append(baseDir)
+
+from utils import ExtendedCVEItemIndexes, CVERow, convert_search_result_to_rows
+
+ROW_LENGTH = ExtendedCVEItemIndexes.length.value + 2
+
+
+def make_rows(count):
+    return [
+        (i, 'CVE-2018-{0:05d}'.format(i)) + tuple('field {0}'.format(j) for j in range(ROW_LENGTH - 2))
+        for i in range(count)]
+
+
+def measure(build, rows):
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = build(rows)
+    elapsed = time.perf_counter() - started
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size, elapsed
+
+
+def main(args):
+    rows = make_rows(int(args[0]) if args else 100000)
+    dicts, dict_bytes, dict_time = measure(lambda items: [CVERow(item).to_json() for item in items], rows)
+    views, view_bytes, view_time = measure(convert_search_result_to_rows, rows)
+    print('{0} rows: dicts {1} bytes in {2:.3f} sec, views {3} bytes in {4:.3f} sec ({5:.1%})'.format(
+        len(rows), dict_bytes, dict_time, view_bytes, view_time, view_bytes / dict_bytes))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
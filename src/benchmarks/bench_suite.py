@@ -0,0 +1,454 @@
+"""
+Offline benchmarks of the DequeDiskCache, SegmentLogCache and CWE ingestion hot paths.
+
+    python bench_suite.py [--quick] [--output results.json] [--compare base.json] [--threshold 0.1]
+
+Every case runs on synthetic CWE and CVE-shaped records and reports ops/sec,
+latency percentiles (of one operation or one batch), bytes on disk and peak
+Python memory. Results are written as JSON; with --compare the run exits
+non-zero if any case lost more than `threshold` of the ops/sec of the base run.
+"""
+import os
+import io
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+from datetime import datetime, timedelta
+
+baseDir = os.path.dirname(os.path.abspath(os.path.dirname(__file__)))
+sys.path.append(baseDir)
+sys.path.append(os.path.join(baseDir, 'plugins'))
+
+from utils import reformat_vulnerabilities_for_output, merge_unique_lists, serialize_as_json_for_cache
+from dskcodecs import loads_value, frame_encoded
+from dskcache import DequeDiskCache
+from dsklog import SegmentLogCache
+from cweparser import iter_cwe_weaknesses, make_cwe_cache_item
+
+RECORD_SIZES = dict(small=1, medium=8, large=64)
+WORDS = ('buffer overflow input validation memory pointer race condition injection '
+         'improper neutralization authentication privilege resource exhaustion').split()
+
+
+def make_text(rnd, sentences):
+    return ' '.join(
+        ' '.join(rnd.choice(WORDS) for _ in range(12)).capitalize() + '.'
+        for _ in range(sentences))
+
+
+def make_cwe_xml(count, record_size='medium', seed=1):
+    rnd = random.Random(seed)
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<Weakness_Catalog Name="CWE" Version="2.8">\n<Weaknesses>\n']
+    for i in range(count):
+        parts.append(
+            '<Weakness ID="{0}" Name="Weakness {0}" Weakness_Abstraction="{1}" Status="{2}">\n'
+            '<Description>\n<Description_Summary>\n\t\t\t\t\t{3}\n</Description_Summary>\n</Description>\n'
+            '</Weakness>\n'.format(
+                i, rnd.choice(['Base', 'Class', 'Variant']), rnd.choice(['Draft', 'Incomplete', 'Usable']),
+                make_text(rnd, RECORD_SIZES[record_size])))
+    parts.append('</Weaknesses>\n</Weakness_Catalog>\n')
+    return ''.join(parts).encode('utf-8')
+
+
+def make_cwe_items(count, record_size='medium', seed=1):
+    return [make_cwe_cache_item(cwe) for cwe in iter_cwe_weaknesses(io.BytesIO(make_cwe_xml(count, record_size, seed)))]
+
+
+def make_cve_rows(count, seed=1):
+    rnd = random.Random(seed)
+    started = datetime(2018, 1, 1)
+    rows = []
+    for i in range(count):
+        cwe = ['CWE-{0}'.format(rnd.randint(1, 900)) for _ in range(rnd.randint(0, 3))]
+        rows.append(dict(
+            id=i,
+            publushed='2018-01-{0:02d}T10:00:00Z'.format(i % 28 + 1),
+            modified=started + timedelta(minutes=i),
+            access='{"vector": "NETWORK", "complexity": "LOW", "authentication": "NONE"}',
+            impact='{"confidentiality": "PARTIAL", "integrity": "PARTIAL", "availability": "PARTIAL"}',
+            cvss_time='2018-02-{0:02d}T10:00:00Z'.format(i % 28 + 1),
+            cvss=rnd.choice([4.3, 5.0, 7.5]),
+            cwe_elements=cwe,
+            cwe=cwe,
+            vulnerability_id='CVE-2018-{0:05d}'.format(i),
+            description=make_text(rnd, 2),
+            capec_elements=[],
+            vulnerable_configuration=['cpe:2.3:a:vendor:product:{0}'.format(rnd.randint(0, count))],
+            references=[dict(url='https://example.org/{0}'.format(rnd.randint(0, count)), name='ref')],
+            vector_string='AV:N/AC:L/Au:N/C:P/I:P/A:P',
+            metadata='{"npm": []}'))
+    return rows
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def directory_size(directory):
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(directory) for name in names)
+
+
+class Case(object):
+    """
+    One benchmark case: setup() builds fresh state, run(state) yields
+    (operations, seconds) for every timed step, bytes_on_disk(state) measures the result.
+    """
+
+    def __init__(self, name, params, setup, run, bytes_on_disk=None, teardown=None):
+        self.name = name
+        self.params = params
+        self.setup = setup
+        self.run = run
+        self.bytes_on_disk = bytes_on_disk
+        self.teardown = teardown
+
+    def measure(self, rounds=3, memory=True):
+        best = None
+        latencies = []
+        disk = 0
+        for _ in range(rounds):
+            state = self.setup()
+            try:
+                steps = list(self.run(state))
+                if self.bytes_on_disk is not None:
+                    disk = self.bytes_on_disk(state)
+            finally:
+                if self.teardown is not None:
+                    self.teardown(state)
+            operations = sum(count for count, _ in steps)
+            elapsed = sum(seconds for _, seconds in steps)
+            latencies = [seconds for _, seconds in steps]
+            if best is None or elapsed < best[1]:
+                best = (operations, elapsed)
+        peak = None
+        if memory:
+            state = self.setup()
+            tracemalloc.start()
+            try:
+                for _ in self.run(state):
+                    pass
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+                if self.teardown is not None:
+                    self.teardown(state)
+        operations, elapsed = best
+        return dict(
+            name=self.name,
+            params=self.params,
+            operations=operations,
+            seconds=elapsed,
+            ops_per_sec=operations / elapsed if elapsed > 0 else 0.0,
+            latency_p50_us=percentile(latencies, 0.50) * 1e6,
+            latency_p90_us=percentile(latencies, 0.90) * 1e6,
+            latency_p99_us=percentile(latencies, 0.99) * 1e6,
+            bytes_on_disk=disk,
+            peak_memory_bytes=peak)
+
+
+def timed(function, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - started
+
+
+def new_cache(compress_level, prefill=None, index_key=None):
+    directory = tempfile.mkdtemp(prefix='bench-dskcache-')
+    cache = DequeDiskCache(directory=directory, compress_level=compress_level, index_key=index_key)
+    if prefill:
+        cache.extend_batched(prefill)
+    return cache
+
+
+def drop_cache(cache):
+    cache._cache.close()
+    if cache.key_index is not None:
+        cache.key_index.close()
+    shutil.rmtree(cache.directory, ignore_errors=True)
+
+
+def cache_size(cache):
+    return directory_size(cache.directory)
+
+
+def dskcache_cases(items_by_size, compress_levels, batch_sizes):
+    cases = []
+    for record_size, items in sorted(items_by_size.items()):
+        for level in compress_levels:
+            params = dict(record_size=record_size, compress_level=level, records=len(items))
+
+            def run_append(cache, items=items):
+                for item in items:
+                    yield 1, timed(cache.append, item)[1]
+
+            cases.append(Case(
+                'dskcache.append', params,
+                lambda level=level: new_cache(level), run_append, cache_size, drop_cache))
+
+            for batch_size in batch_sizes:
+                def run_extend(cache, items=items, batch_size=batch_size):
+                    for start in range(0, len(items), batch_size):
+                        batch = items[start:start + batch_size]
+                        yield len(batch), timed(cache.extend_batched, batch, batch_size)[1]
+
+                cases.append(Case(
+                    'dskcache.extend_batched', dict(params, batch_size=batch_size),
+                    lambda level=level: new_cache(level), run_extend, cache_size, drop_cache))
+
+            def run_popleft(cache, count=len(items)):
+                for _ in range(count):
+                    yield 1, timed(cache.popleft)[1]
+
+            cases.append(Case(
+                'dskcache.popleft', params,
+                lambda level=level, items=items: new_cache(level, items), run_popleft, None, drop_cache))
+
+            for batch_size in batch_sizes:
+                def run_popleft_many(cache, count=len(items), batch_size=batch_size):
+                    for _ in range(0, count, batch_size):
+                        values, seconds = timed(cache.popleft_many, batch_size)
+                        yield len(values), seconds
+
+                cases.append(Case(
+                    'dskcache.popleft_many', dict(params, batch_size=batch_size),
+                    lambda level=level, items=items: new_cache(level, items), run_popleft_many, None, drop_cache))
+
+            lookups = items[::max(1, len(items) // 200)]
+
+            def run_index(cache, lookups=lookups):
+                for item in lookups:
+                    yield 1, timed(cache.index, item, 0, len(cache))[1]
+
+            cases.append(Case(
+                'dskcache.index', dict(params, lookups=len(lookups)),
+                lambda level=level, items=items: new_cache(level, items, 'hash'), run_index, cache_size, drop_cache))
+    return cases
+
+
+def new_log(compress_level, prefill=None):
+    log = SegmentLogCache(
+        directory=tempfile.mkdtemp(prefix='bench-dsklog-'), compress_level=compress_level, compact_interval=0)
+    if prefill:
+        log.extend_batched(prefill)
+    return log
+
+
+def drop_log(log):
+    log.close()
+    shutil.rmtree(log.directory, ignore_errors=True)
+
+
+def log_size(log):
+    return directory_size(log.directory)
+
+
+def dsklog_cases(items_by_size, compress_levels, batch_sizes):
+    cases = []
+    for record_size, items in sorted(items_by_size.items()):
+        for level in compress_levels:
+            params = dict(record_size=record_size, compress_level=level, records=len(items))
+
+            def run_append(log, items=items):
+                for item in items:
+                    yield 1, timed(log.append, item)[1]
+
+            cases.append(Case(
+                'dsklog.append', params, lambda level=level: new_log(level), run_append, log_size, drop_log))
+
+            for batch_size in batch_sizes:
+                def run_extend(log, items=items, batch_size=batch_size):
+                    for start in range(0, len(items), batch_size):
+                        batch = items[start:start + batch_size]
+                        yield len(batch), timed(log.extend_batched, batch, batch_size)[1]
+
+                def run_popleft_many(log, count=len(items), batch_size=batch_size):
+                    for _ in range(0, count, batch_size):
+                        values, seconds = timed(log.popleft_many, batch_size)
+                        yield len(values), seconds
+
+                cases.append(Case(
+                    'dsklog.extend_batched', dict(params, batch_size=batch_size),
+                    lambda level=level: new_log(level), run_extend, log_size, drop_log))
+                cases.append(Case(
+                    'dsklog.popleft_many', dict(params, batch_size=batch_size),
+                    lambda level=level, items=items: new_log(level, items), run_popleft_many, None, drop_log))
+    return cases
+
+
+def global_cache_cases(items_by_size, batch_sizes):
+    """
+    CPU cost of preparing staged items for the global cache:
+    decode and serialize them again, or pass the encoded blobs through.
+    """
+    cases = []
+    for record_size, items in sorted(items_by_size.items()):
+        for batch_size in batch_sizes:
+            params = dict(record_size=record_size, records=len(items), batch_size=batch_size)
+
+            def run_roundtrip(cache, count=len(items), batch_size=batch_size):
+                for _ in range(0, count, batch_size):
+                    started = time.perf_counter()
+                    values = cache.popleft_many(batch_size, compressed=False)
+                    payloads = [serialize_as_json_for_cache(loads_value(value)) for value in values]
+                    yield len(payloads), time.perf_counter() - started
+
+            def run_passthrough(cache, count=len(items), batch_size=batch_size):
+                for _ in range(0, count, batch_size):
+                    started = time.perf_counter()
+                    payloads = [frame_encoded(blob) for blob in cache.popleft_blobs(batch_size)]
+                    yield len(payloads), time.perf_counter() - started
+
+            cases.append(Case(
+                'cwe.global.roundtrip', params,
+                lambda items=items: new_cache(1, items), run_roundtrip, None, drop_cache))
+            cases.append(Case(
+                'cwe.global.passthrough', params,
+                lambda items=items: new_cache(1, items), run_passthrough, None, drop_cache))
+    return cases
+
+
+def cwe_parser_cases(records, record_sizes, chunk_sizes):
+    cases = []
+    for record_size in record_sizes:
+        xml = make_cwe_xml(records, record_size)
+        for chunk_size in chunk_sizes:
+            def run_parse(_, xml=xml, chunk_size=chunk_size):
+                data = io.BytesIO(xml)
+                started = time.perf_counter()
+                for _ in iter_cwe_weaknesses(data, chunk_size):
+                    now = time.perf_counter()
+                    yield 1, now - started
+                    started = now
+
+            cases.append(Case(
+                'cwe.parse', dict(record_size=record_size, chunk_size=chunk_size, records=records, xml_bytes=len(xml)),
+                lambda: None, run_parse))
+    return cases
+
+
+def utils_cases(rows, batch_sizes):
+    cases = []
+    data = make_cve_rows(rows)
+    for batch_size in batch_sizes:
+        def run_format(_, batch_size=batch_size):
+            for start in range(0, len(data), batch_size):
+                batch = data[start:start + batch_size]
+                yield len(batch), timed(reformat_vulnerabilities_for_output, batch)[1]
+
+        cases.append(Case('utils.reformat_vulnerabilities_for_output', dict(rows=rows, batch_size=batch_size),
+                          lambda: None, run_format))
+
+    def run_merge(_):
+        for field in ('vulnerable_configuration', 'references'):
+            lists = [row[field] for row in data]
+            yield len(lists), timed(merge_unique_lists, *lists)[1]
+
+    cases.append(Case('utils.merge_unique_lists', dict(rows=rows), lambda: None, run_merge))
+    return cases
+
+
+def make_cases(quick=False):
+    records = 500 if quick else 5000
+    compress_levels = (1, 6) if quick else (1, 6, 9)
+    batch_sizes = (50, 500)
+    record_sizes = ('small', 'large') if quick else sorted(RECORD_SIZES)
+    items_by_size = dict((size, make_cwe_items(records, size)) for size in record_sizes)
+    return (dskcache_cases(items_by_size, compress_levels, batch_sizes) +
+            dsklog_cases(items_by_size, compress_levels, batch_sizes) +
+            global_cache_cases(items_by_size, batch_sizes) +
+            cwe_parser_cases(records * 2, record_sizes, (4 * 1024, 64 * 1024)) +
+            utils_cases(records * 2, batch_sizes))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=baseDir, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def case_key(result):
+    return result['name'], json.dumps(result['params'], sort_keys=True)
+
+
+def compare(results, base, threshold):
+    """
+    Print ops/sec against the base run. Return the number of regressed cases.
+    """
+    base_results = dict((case_key(result), result) for result in base['results'])
+    regressions = 0
+    print('{0:<44}{1:>14}{2:>14}{3:>10}'.format('case', 'base ops/s', 'ops/s', 'change'))
+    for result in results:
+        previous = base_results.get(case_key(result))
+        if previous is None or not previous['ops_per_sec']:
+            continue
+        change = result['ops_per_sec'] / previous['ops_per_sec'] - 1
+        flag = ''
+        if change < -threshold:
+            regressions += 1
+            flag = ' REGRESSION'
+        print('{0:<44}{1:>14.0f}{2:>14.0f}{3:>+10.1%}{4} {5}'.format(
+            result['name'], previous['ops_per_sec'], result['ops_per_sec'], change, flag,
+            json.dumps(result['params'], sort_keys=True)))
+    return regressions
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='DequeDiskCache and CWE ingestion benchmarks')
+    parser.add_argument('--quick', action='store_true', help='smaller data and fewer parameters')
+    parser.add_argument('--rounds', type=int, default=3, help='timed rounds per case, the best one is kept')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc pass')
+    parser.add_argument('--filter', default='', help='run only cases whose name contains this text')
+    parser.add_argument('--output', help='write results JSON to this file instead of stdout')
+    parser.add_argument('--compare', help='results JSON of a base run')
+    parser.add_argument('--threshold', type=float, default=0.1, help='allowed ops/sec loss against the base run')
+    options = parser.parse_args(args)
+
+    cases = [case for case in make_cases(options.quick) if options.filter in case.name]
+    results = []
+    for case in cases:
+        result = case.measure(options.rounds, memory=not options.no_memory)
+        results.append(result)
+        print('{0:<44}{1:>14.0f} ops/s  p99 {2:>10.1f} us  {3}'.format(
+            result['name'], result['ops_per_sec'], result['latency_p99_us'],
+            json.dumps(result['params'], sort_keys=True)), file=sys.stderr)
+
+    report = dict(
+        meta=dict(
+            commit=git_commit(),
+            time=datetime.utcnow().isoformat(),
+            python=platform.python_version(),
+            platform=platform.platform(),
+            quick=options.quick,
+            rounds=options.rounds),
+        results=results)
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if options.compare:
+        with open(options.compare) as base_file:
+            base = json.load(base_file)
+        if compare(results, base, options.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,280 @@
+import os
+import sys
+import time
+import redis
+import threading
+from collections import OrderedDict
+
+baseDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(baseDir, 'plugins'))
+
+from settings import SETTINGS
+from logger import LOGERR_IF_ENABLED
+from utils import get_module_name, serialize_as_json_for_cache, deserialize_as_json_for_cache
+from dskcodecs import CONTENT_ENCODING_DSK, frame_encoded, is_framed, loads_framed
+
+SOURCE_MODULE = '[{0}] :: '.format(get_module_name(__file__))
+
+_cache = None
+_raw_cache = None
+
+
+def get_cache(raw=False):
+    """
+    Get shared connection to the cache Redis DB.
+    With `raw` the connection returns bytes, as needed for pre-encoded values.
+    """
+    global _cache, _raw_cache
+    if raw:
+        if _raw_cache is None:
+            _raw_cache = redis.StrictRedis(
+                host=SETTINGS["cache"]["host"],
+                port=SETTINGS["cache"]["port"],
+                db=SETTINGS["cache"]["db"],
+                decode_responses=False)
+        return _raw_cache
+    if _cache is None:
+        _cache = redis.StrictRedis(
+            host=SETTINGS["cache"]["host"],
+            port=SETTINGS["cache"]["port"],
+            db=SETTINGS["cache"]["db"],
+            encoding=SETTINGS["cache"]["charset"],
+            decode_responses=SETTINGS["cache"]["decode_responses"])
+    return _cache
+
+
+def make_key(*parts):
+    """
+    Build a cache key, e.g. make_key('cwe', '79') -> 'cwe::79'.
+    """
+    return SETTINGS["cache"]["separator"].join(str(part) for part in parts)
+
+
+def make_encoded_key(key):
+    """
+    Key of a pre-encoded value written by VulnerabilityCache.set_many_encoded,
+    e.g. make_encoded_key('cwe::79') -> 'dsk::cwe::79'. Such values are binary
+    frames, so they are kept apart from the JSON values read through get_cache().
+    """
+    return make_key(SETTINGS["cache"].get("encoded_namespace", "dsk"), key)
+
+
+class LRUCache(object):
+    """
+    Thread-safe in-process LRU with a bounded size and per-entry TTL.
+    """
+
+    def __init__(self, maxsize=10000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, None)
+            if entry is None:
+                return default
+            value, expire_at = entry
+            if expire_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class VulnerabilityCache(object):
+    """
+    Two-tier cache: a bounded local LRU in front of the Redis cache DB.
+    Writes go through one pipeline with the configured expiry and keep
+    keys in the SETTINGS["cache"]["index"] set, which expires with the latest
+    write and is pruned of expired keys by keys(); reads of many keys use MGET.
+    set_many_encoded stores values already encoded by DequeDiskCache as they are,
+    framed with their content encoding, under make_encoded_key(key) through
+    `raw_connection`, which returns bytes; it is never the JSON `connection`.
+    Plain keys keep holding JSON only. get and get_many read the plain key and
+    fall back to the encoded one, writes of either kind delete the other.
+    """
+
+    _missing = object()
+
+    def __init__(self, connection=None, local_size=None, local_ttl=None, expire=None, raw_connection=None):
+        settings = SETTINGS["cache"]
+        self.connection = connection or get_cache()
+        self.raw_connection = raw_connection or get_cache(raw=True)
+        self.local = LRUCache(
+            maxsize=local_size or settings.get("local_size", 10000),
+            ttl=local_ttl or settings.get("local_ttl_in_sec", 60))
+        self.expire = expire or settings["key_expire_time_in_sec"]
+        self.index = settings["index"]
+
+    def get(self, key, default=None):
+        value = self.local.get(key, self._missing)
+        if value is not self._missing:
+            return value
+        try:
+            raw = self.connection.get(key)
+            if raw is None:
+                value = self._loads_encoded(self.raw_connection.get(make_encoded_key(key)))
+            else:
+                value = deserialize_as_json_for_cache(raw)
+        except redis.RedisError as ex:
+            LOGERR_IF_ENABLED(SOURCE_MODULE, '[-] Got exception during reading cache: {0}'.format(ex))
+            return default
+        if value is None:
+            return default
+        self.local.set(key, value)
+        return value
+
+    @staticmethod
+    def _loads_encoded(raw):
+        if raw is None:
+            return None
+        if not is_framed(raw):
+            LOGERR_IF_ENABLED(SOURCE_MODULE, '[-] Got unframed encoded cache value')
+            return None
+        try:
+            return loads_framed(raw)
+        except ValueError as ex:
+            LOGERR_IF_ENABLED(SOURCE_MODULE, '[-] Got exception during decoding cache value: {0}'.format(ex))
+            return None
+
+    def get_many(self, keys):
+        """
+        Return key -> value for every cached key; local misses are fetched with one MGET,
+        and keys missing there with one MGET of their encoded keys.
+        """
+        found = {}
+        misses = []
+        for key in keys:
+            value = self.local.get(key, self._missing)
+            if value is self._missing:
+                misses.append(key)
+            else:
+                found[key] = value
+        if not misses:
+            return found
+        try:
+            raws = self.connection.mget(misses)
+            loaded = dict((key, deserialize_as_json_for_cache(raw)) for key, raw in zip(misses, raws) if raw is not None)
+            misses = [key for key in misses if key not in loaded]
+            if misses:
+                raws = self.raw_connection.mget([make_encoded_key(key) for key in misses])
+                loaded.update((key, self._loads_encoded(raw)) for key, raw in zip(misses, raws))
+        except redis.RedisError as ex:
+            LOGERR_IF_ENABLED(SOURCE_MODULE, '[-] Got exception during reading cache: {0}'.format(ex))
+            return found
+        for key, value in loaded.items():
+            if value is not None:
+                self.local.set(key, value)
+                found[key] = value
+        return found
+
+    def set(self, key, value):
+        return self.set_many({key: value})
+
+    def set_many(self, mapping):
+        """
+        Write key -> value pairs in one pipeline. Return the number of written keys.
+        """
+        if not mapping:
+            return 0
+        try:
+            pipe = self.connection.pipeline(transaction=False)
+            for key, value in mapping.items():
+                pipe.set(key, serialize_as_json_for_cache(value), ex=self.expire)
+            pipe.delete(*[make_encoded_key(key) for key in mapping])
+            pipe.srem(self.index, *[make_encoded_key(key) for key in mapping])
+            pipe.sadd(self.index, *mapping.keys())
+            pipe.expire(self.index, self.expire)
+            pipe.execute()
+        except redis.RedisError as ex:
+            LOGERR_IF_ENABLED(SOURCE_MODULE, '[-] Got exception during writing cache: {0}'.format(ex))
+            return 0
+        for key, value in mapping.items():
+            self.local.set(key, value)
+        return len(mapping)
+
+    def set_many_encoded(self, mapping, content_encoding=CONTENT_ENCODING_DSK):
+        """
+        Write key -> pre-encoded value (bytes or memoryview from DequeDiskCache blobs)
+        pairs in one pipeline without decoding them, under make_encoded_key(key).
+        Return the number of written keys.
+        """
+        if not mapping:
+            return 0
+        encoded_keys = [make_encoded_key(key) for key in mapping]
+        try:
+            pipe = self.raw_connection.pipeline(transaction=False)
+            for encoded_key, value in zip(encoded_keys, mapping.values()):
+                pipe.set(encoded_key, frame_encoded(value, content_encoding), ex=self.expire)
+            pipe.delete(*mapping.keys())
+            pipe.srem(self.index, *mapping.keys())
+            pipe.sadd(self.index, *encoded_keys)
+            pipe.expire(self.index, self.expire)
+            pipe.execute()
+        except redis.RedisError as ex:
+            LOGERR_IF_ENABLED(SOURCE_MODULE, '[-] Got exception during writing cache: {0}'.format(ex))
+            return 0
+        for key in mapping:
+            self.local.delete(key)
+        return len(mapping)
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return 0
+        for key in keys:
+            self.local.delete(key)
+        keys += [make_encoded_key(key) for key in keys]
+        try:
+            pipe = self.connection.pipeline(transaction=False)
+            pipe.delete(*keys)
+            pipe.srem(self.index, *keys)
+            deleted, _ = pipe.execute()
+            return deleted
+        except redis.RedisError as ex:
+            LOGERR_IF_ENABLED(SOURCE_MODULE, '[-] Got exception during deleting from cache: {0}'.format(ex))
+            return 0
+
+    def keys(self):
+        """
+        Cached keys from the index set, encoded values under their plain key.
+        Members whose keys have expired are removed from it.
+        """
+        members = list(self.connection.smembers(self.index))
+        if not members:
+            return set()
+        pipe = self.connection.pipeline(transaction=False)
+        for key in members:
+            pipe.exists(key)
+        expired = [key for key, exists in zip(members, pipe.execute()) if not exists]
+        if expired:
+            self.connection.srem(self.index, *expired)
+        prefix = make_encoded_key('')
+        return set(key[len(prefix):] if key.startswith(prefix) else key for key in set(members) - set(expired))
+
+    def clear(self):
+        self.local.clear()
+        keys = list(self.keys())
+        if keys:
+            self.delete_many(keys)
+        self.connection.delete(self.index)
@@ -0,0 +1,227 @@
+import os
+import sys
+import json
+import time
+import peewee
+from contextlib import contextmanager
+from playhouse.pool import PooledPostgresqlDatabase, MaxConnectionsExceeded
+
+baseDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(baseDir, 'plugins'))
+
+from settings import SETTINGS
+from logger import LOGERR_IF_ENABLED, LOGINFO_IF_ENABLED
+from utils import get_module_name, chunked
+from models.model_cwe import VULNERABILITIES_CWE, cwe_db_proxy
+from dskcodecs import loads_value
+from dskgroups import default_consumer
+
+SOURCE_MODULE = '[{0}] :: '.format(get_module_name(__file__))
+
+CWE_UPSERT_FIELDS = [
+    VULNERABILITIES_CWE.name,
+    VULNERABILITIES_CWE.status,
+    VULNERABILITIES_CWE.weaknesses,
+    VULNERABILITIES_CWE.description_summary,
+]
+
+
+def make_postgres_database():
+    """
+    Pooled, thread-safe Postgres database: every thread gets its own
+    connection from a pool of at most `max_connections`, and connections
+    idle longer than `stale_timeout_in_sec` are recycled.
+    """
+    settings = SETTINGS["postgres"]
+    return PooledPostgresqlDatabase(
+        settings["database"],
+        max_connections=settings.get("max_connections", 8),
+        stale_timeout=settings.get("stale_timeout_in_sec", 300),
+        user=settings["user"],
+        password=settings["password"],
+        host=settings["host"],
+        port=int(settings["port"]))
+
+
+def init_databases(database=None):
+    """
+    Initialize model proxies with the pooled Postgres database.
+    """
+    database = database or make_postgres_database()
+    cwe_db_proxy.initialize(database)
+    return database
+
+
+def connect_with_retry(database=cwe_db_proxy, reconnect_count=None):
+    """
+    Open (or reuse) the connection of the current thread.
+    Failed attempts and an exhausted pool are retried up to `reconnect_count` times with capped exponential backoff.
+    Return True if a new connection was opened.
+    """
+    settings = SETTINGS["postgres"]
+    if reconnect_count is None:
+        reconnect_count = settings.get("reconnect_count", 1000)
+    backoff = settings.get("reconnect_backoff_in_sec", 1)
+    backoff_max = settings.get("reconnect_backoff_max_in_sec", 30)
+    attempt = 0
+    while True:
+        try:
+            return database.connect(reuse_if_open=True)
+        except (peewee.OperationalError, peewee.InterfaceError, MaxConnectionsExceeded) as ex:
+            if attempt >= reconnect_count:
+                LOGERR_IF_ENABLED(SOURCE_MODULE, '[-] Give up connecting to database: {0}'.format(ex))
+                raise
+            delay = min(backoff_max, backoff * (2 ** min(attempt, 16)))
+            attempt += 1
+            LOGERR_IF_ENABLED(SOURCE_MODULE, '[-] Reconnect {0} of {1} in {2} sec: {3}'.format(
+                attempt, reconnect_count, delay, ex))
+            time.sleep(delay)
+
+
+@contextmanager
+def connection(database=cwe_db_proxy):
+    """
+    Hold a pooled connection for the current thread and return it to the pool afterwards.
+    Nested use keeps the outer connection open.
+    """
+    opened = connect_with_retry(database)
+    try:
+        yield database
+    finally:
+        if opened and not database.is_closed():
+            database.close()
+
+
+def get_updater_offset():
+    return SETTINGS.get("postgres", {}).get("updater_offset", 1000)
+
+
+def create_cwe_table(database=cwe_db_proxy):
+    """
+    Create vulnerabilities_cwe with the unique index on cwe_id.
+    The index is also added to tables created before it existed.
+    """
+    with connection(database), database.bind_ctx([VULNERABILITIES_CWE]):
+        if SETTINGS.get("cwe", {}).get("drop_cwe_table", False):
+            VULNERABILITIES_CWE.drop_table(safe=True)
+        VULNERABILITIES_CWE.create_table(safe=True)
+        database.execute_sql(
+            'CREATE UNIQUE INDEX IF NOT EXISTS vulnerabilities_cwe_cwe_id '
+            'ON vulnerabilities_cwe (cwe_id)')
+
+
+def cwe_record_to_row(cwe):
+    return dict(
+        cwe_id=cwe.get('id', ''),
+        name=cwe.get('name', '') or '',
+        status=cwe.get('status', '') or '',
+        weaknesses=cwe.get('weaknesses', '') or '',
+        description_summary=cwe.get('description_summary', '') or '')
+
+
+def upsert_cwe_records(records, database=cwe_db_proxy, chunk_size=None):
+    """
+    Upsert parsed CWE records with one multi-row
+    INSERT ... ON CONFLICT (cwe_id) DO UPDATE per chunk of `updater_offset` rows.
+    Return the number of upserted records.
+    """
+    chunk_size = chunk_size or get_updater_offset()
+    count = 0
+    with connection(database), database.bind_ctx([VULNERABILITIES_CWE]):
+        with database.atomic():
+            for chunk in chunked(records, chunk_size):
+                rows = dict((row['cwe_id'], row) for row in map(cwe_record_to_row, chunk))
+                VULNERABILITIES_CWE.insert_many(list(rows.values())).on_conflict(
+                    conflict_target=[VULNERABILITIES_CWE.cwe_id],
+                    preserve=CWE_UPSERT_FIELDS).execute()
+                count += len(rows)
+    return count
+
+
+def delete_cwe_records(cwe_ids, database=cwe_db_proxy, chunk_size=None):
+    chunk_size = chunk_size or get_updater_offset()
+    count = 0
+    with connection(database), database.bind_ctx([VULNERABILITIES_CWE]):
+        with database.atomic():
+            for chunk in chunked(cwe_ids, chunk_size):
+                count += VULNERABILITIES_CWE.delete().where(VULNERABILITIES_CWE.cwe_id.in_(chunk)).execute()
+    return count
+
+
+def drain_cwe_cache(cache, database=cwe_db_proxy, chunk_size=None):
+    """
+    Pop CWE items staged in a DequeDiskCache and load them into vulnerabilities_cwe
+    chunk by chunk. Items marked 'removed' are deleted. A chunk that fails to load
+    is put back to the head of the cache. Return the number of loaded items.
+    """
+    chunk_size = chunk_size or get_updater_offset()
+    with connection(database):
+        return _drain_cwe_cache(cache, database, chunk_size)
+
+
+def load_cwe_items(values, zdicts, database, chunk_size):
+    """
+    Upsert or delete (for 'removed' items) the encoded CWE cache values.
+    Only the last staged item of every id counts, so the upserted and
+    deleted ids are disjoint and the order between the two batches does not matter.
+    """
+    items = [loads_value(value, zdicts) for value in values]
+    items = [json.loads(item) if isinstance(item, str) else item for item in items]
+    latest = {}
+    for item in items:
+        cwe_id = item['data']['id']
+        latest.pop(cwe_id, None)
+        latest[cwe_id] = item
+    upsert_cwe_records(
+        [item['data'] for item in latest.values() if item.get('state') != 'removed'],
+        database, chunk_size)
+    delete_cwe_records(
+        [cwe_id for cwe_id, item in latest.items() if item.get('state') == 'removed'],
+        database, chunk_size)
+
+
+def _drain_cwe_cache(cache, database, chunk_size):
+    count = 0
+    while True:
+        values = cache.popleft_many(chunk_size, compressed=False)
+        if not values:
+            return count
+        try:
+            load_cwe_items(values, cache.zdicts, database, chunk_size)
+        except Exception as ex:
+            LOGERR_IF_ENABLED(SOURCE_MODULE, '[-] Got exception during loading CWE chunk: {0}'.format(ex))
+            try:
+                cache.extendleft(reversed(values), compressed=False)
+            except Exception as put_back_error:
+                LOGERR_IF_ENABLED(SOURCE_MODULE, '[-] Can not put the CWE chunk back to the cache: {0}'.format(
+                    put_back_error))
+            raise
+        count += len(values)
+        LOGINFO_IF_ENABLED(SOURCE_MODULE, '[+] Loaded {0} CWE items into Postgres'.format(count))
+
+
+def drain_cwe_cache_group(group, consumer=None, database=cwe_db_proxy, chunk_size=None):
+    """
+    Claim CWE items from a dskgroups.ConsumerGroup and load them into vulnerabilities_cwe.
+    Several processes may drain the same group: each chunk is acknowledged after
+    it is loaded, and a chunk that fails is released for redelivery.
+    Return the number of loaded items.
+    """
+    chunk_size = chunk_size or get_updater_offset()
+    consumer = consumer or default_consumer()
+    count = 0
+    with connection(database):
+        while True:
+            claimed = group.claim(chunk_size, consumer, compressed=False)
+            if not claimed:
+                return count
+            sequences = [sequence for sequence, _ in claimed]
+            try:
+                load_cwe_items([value for _, value in claimed], group.cache.zdicts, database, chunk_size)
+            except Exception as ex:
+                LOGERR_IF_ENABLED(SOURCE_MODULE, '[-] Got exception during loading CWE chunk: {0}'.format(ex))
+                group.nack(sequences, consumer)
+                raise
+            count += group.ack(sequences, consumer)
+            LOGINFO_IF_ENABLED(SOURCE_MODULE, '[+] Loaded {0} CWE items into Postgres from group {1}'.format(
+                count, group.name))
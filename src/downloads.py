@@ -0,0 +1,249 @@
+import time
+import socket
+import random
+import threading
+import requests
+from datetime import datetime
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+
+from settings import SETTINGS
+from logger import LOGERR_IF_ENABLED, LOGINFO_IF_ENABLED
+from utils import get_module_name, spool_response, open_spooled_file, NOT_MODIFIED, DOWNLOAD_LISTENERS
+
+SOURCE_MODULE = '[{0}] :: '.format(get_module_name(__file__))
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# The host answered but the body broke off or could not be decoded.
+RETRY_BODY_ERRORS = (requests.exceptions.ChunkedEncodingError, requests.exceptions.ContentDecodingError)
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def make_download_sources(start_year=None, end_year=None):
+    """
+    Get name -> url of every source fetched by a full refresh:
+    all CVE years from SETTINGS["cve"]["start_year"] plus CWE, CAPEC and NPM.
+    """
+    start_year = start_year or SETTINGS["cve"]["start_year"]
+    end_year = end_year or datetime.utcnow().year
+    sources = dict(
+        ('cve_{0}'.format(year), SETTINGS["cve"]["source"].format(year=year))
+        for year in range(start_year, end_year + 1))
+    sources["cwe"] = SETTINGS["cwe"]["source"]
+    sources["capec"] = SETTINGS["capec"]["source"]
+    sources["npm"] = SETTINGS["npm"]["source"]
+    return sources
+
+
+def host_of(url):
+    parsed = urlparse(url)
+    return parsed.hostname, parsed.port or DEFAULT_PORTS.get(parsed.scheme, 80)
+
+
+class ConnectivityOracle(object):
+    """
+    Shared, cached view of whether the real source hosts are reachable.
+    Lookups never block: stale or unknown hosts are re-probed in the background
+    and unknown hosts count as online, so a job starts at once and fails fast
+    on its own download. Downloader and utils.get_file feed their outcome
+    back through `mark`; run_plugins starts the background probe.
+    """
+
+    def __init__(self, urls=None, ttl=None, timeout=None):
+        settings = SETTINGS.get("download", {})
+        self.hosts = sorted(set(host_of(url) for url in (urls or make_download_sources().values())))
+        self.ttl = ttl or settings.get("connectivity_ttl_in_sec", 60)
+        self.timeout = timeout or settings.get("connectivity_timeout_in_sec", 3)
+        self._status = {}
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def probe(self, host):
+        try:
+            socket.create_connection(host, timeout=self.timeout).close()
+            return True
+        except OSError:
+            return False
+
+    def mark(self, url, online):
+        with self._lock:
+            self._status[host_of(url)] = (online, time.monotonic())
+
+    def refresh(self, hosts=None):
+        hosts = hosts or self.hosts
+        with ThreadPoolExecutor(max_workers=max(len(hosts), 1)) as executor:
+            results = list(executor.map(self.probe, hosts))
+        now = time.monotonic()
+        with self._lock:
+            for host, online in zip(hosts, results):
+                self._status[host] = (online, now)
+        for host, online in zip(hosts, results):
+            if not online:
+                LOGERR_IF_ENABLED(SOURCE_MODULE, '[-] Source host {0}:{1} is unreachable'.format(*host))
+
+    def _refresh_in_background(self, hosts):
+        try:
+            self.refresh(hosts)
+        finally:
+            with self._lock:
+                self._refreshing.difference_update(hosts)
+
+    def refresh_async(self, hosts=None):
+        """
+        Probe `hosts` in a background thread, skipping hosts whose probe is already running.
+        """
+        with self._lock:
+            hosts = [host for host in (hosts or self.hosts) if host not in self._refreshing]
+            if not hosts:
+                return
+            self._refreshing.update(hosts)
+        threading.Thread(
+            target=self._refresh_in_background, args=(hosts, ),
+            name='ConnectivityOracleRefresh', daemon=True).start()
+
+    def is_online(self, url=None):
+        """
+        Cached reachability of the host of `url`, or of any source host.
+        """
+        hosts = [host_of(url)] if url else self.hosts
+        now = time.monotonic()
+        with self._lock:
+            statuses = [self._status.get(host) for host in hosts]
+        stale = [host for host, status in zip(hosts, statuses) if status is None or now - status[1] > self.ttl]
+        if stale:
+            self.refresh_async(stale)
+        known = [status[0] for status in statuses if status is not None]
+        if not known:
+            return True
+        return any(known)
+
+    def _run(self, interval):
+        while not self._stop.is_set():
+            self.refresh()
+            self._stop.wait(interval)
+
+    def start(self, interval=None):
+        """
+        Keep the cache warm by re-probing all hosts every `interval` seconds.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, args=(interval or self.ttl, ),
+            name='ConnectivityOracle', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+connectivity = ConnectivityOracle()
+DOWNLOAD_LISTENERS.append(connectivity.mark)
+
+
+class Downloader(object):
+    """
+    Fetch many sources in parallel over one pooled keep-alive session.
+    Concurrency is bounded overall by `max_workers` and per host by `per_host_limit`.
+    Failed attempts are retried with jittered exponential backoff.
+    Results follow the get_file convention: (data, response) or (None, error);
+    response.sha256 is the digest of the downloaded bytes.
+    The CWE updater job fetches its source with fetch_all; all URLs are
+    arguments, so tests run it against a local http.server.
+    """
+
+    def __init__(self, max_workers=None, per_host_limit=None, retry_count=None,
+                 retry_timeout=None, backoff_base=None, timeout=None, proxy=None):
+        settings = SETTINGS.get("download", {})
+        self.max_workers = max_workers or settings.get("max_workers", 8)
+        self.per_host_limit = per_host_limit or settings.get("per_host_limit", 4)
+        self.retry_count = retry_count if retry_count is not None else SETTINGS["cve"]["download_retry_count"]
+        self.retry_timeout = retry_timeout or SETTINGS["cve"]["download_retry_timeout_in_sec"]
+        self.backoff_base = backoff_base or settings.get("backoff_base_in_sec", 1)
+        self.timeout = timeout or settings.get("timeout_in_sec", 60)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=self.max_workers,
+            pool_maxsize=max(self.max_workers, self.per_host_limit))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if proxy:
+            self.session.proxies = {'http': proxy, 'https': proxy}
+        self._host_limits = defaultdict(lambda: threading.BoundedSemaphore(self.per_host_limit))
+        self._host_limits_lock = threading.Lock()
+
+    def _host_limit(self, url):
+        with self._host_limits_lock:
+            return self._host_limits[urlparse(url).netloc]
+
+    def backoff(self, attempt):
+        """
+        Full jitter: uniform delay up to base * 2^attempt, capped by the retry timeout.
+        """
+        return random.uniform(0, min(self.retry_timeout, self.backoff_base * (2 ** attempt)))
+
+    def _fetch_once(self, url, headers, unpack):
+        with self._host_limit(url):
+            response = self.session.get(url, headers=headers or {}, stream=True, timeout=self.timeout)
+            try:
+                if response.status_code == 304:
+                    return None, NOT_MODIFIED
+                response.raise_for_status()
+                spool = spool_response(response)
+            finally:
+                response.close()
+        return open_spooled_file(spool, response.headers.get('Content-Type', ''), unpack), response
+
+    def fetch(self, url, headers=None, unpack=True):
+        attempt = 0
+        while True:
+            try:
+                result = self._fetch_once(url, headers, unpack)
+                connectivity.mark(url, True)
+                return result
+            except requests.HTTPError as ex:
+                if ex.response is None or ex.response.status_code not in RETRY_STATUS_CODES:
+                    return None, str(ex)
+                error = ex
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                connectivity.mark(url, False)
+                error = ex
+            except RETRY_BODY_ERRORS as ex:
+                error = ex
+            except Exception as ex:
+                return None, str(ex)
+            if attempt >= self.retry_count:
+                LOGERR_IF_ENABLED(SOURCE_MODULE, '[-] Give up downloading {0}: {1}'.format(url, error))
+                return None, str(error)
+            delay = self.backoff(attempt)
+            attempt += 1
+            LOGINFO_IF_ENABLED(SOURCE_MODULE, '[r] Retry {0} of {1} for {2} in {3:.1f} sec: {4}'.format(
+                attempt, self.retry_count, url, delay, error))
+            time.sleep(delay)
+
+    def fetch_all(self, sources, headers=None, unpack=True):
+        """
+        Fetch name -> url sources concurrently.
+        Return name -> (data, response) once the slowest download completes.
+        `headers` may map a source name to its own request headers.
+        """
+        headers = headers or {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = dict(
+                (name, executor.submit(self.fetch, url, headers.get(name), unpack))
+                for name, url in sources.items())
+            return dict((name, future.result()) for name, future in futures.items())
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
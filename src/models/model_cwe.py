@@ -10,7 +10,7 @@ class VULNERABILITIES_CWE(peewee.Model):
         table_name = "vulnerabilities_cwe"
 
     id = peewee.PrimaryKeyField(null=False, )
-    cwe_id = peewee.TextField(default="", )
+    cwe_id = peewee.TextField(default="", unique=True)
     name = peewee.TextField(default="", )
     status = peewee.TextField(default="", )
     weaknesses = peewee.TextField(default="", )
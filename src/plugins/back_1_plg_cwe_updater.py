@@ -3,58 +3,34 @@ import sys
 import time
 import json
 import zlib
+import diskcache
 from threading import Thread
-from xml.sax import make_parser
-from xml.sax.handler import ContentHandler
 from datetime import datetime
 
 baseDir = os.path.dirname(os.path.abspath(os.path.dirname(__file__)))
 sys.path.append(baseDir)
 
 from logger import LOGERR_IF_ENABLED, LOGINFO_IF_ENABLED
-from utils import get_file, get_module_name, check_internet_connection
+from utils import get_module_name, chunked
+from utils import make_conditional_headers, NOT_MODIFIED
 from settings import SETTINGS
+from queues import push_to_queue
+from downloads import connectivity, Downloader
+from databases import init_databases, connection
 
-from dskcache import DequeDiskCache as dc
+from dskcache import CWE_STATE_DIRECTORY
+from dsklog import make_cwe_cache
+from dskcodecs import content_key
+from cweparser import iter_cwe_weaknesses, make_cwe_cache_item
 
-SOURCE_MODULE = '[{0}] :: '.format(get_module_name(__file__))
-PLUGIN_NAME = get_module_name(__file__)
+dc = make_cwe_cache()
 
+# Source validators and per-record content hashes of the previous run:
+# 'source' -> dict(etag, last_modified, sha256), ('record', cwe_id) -> content hash.
+cwe_state = diskcache.Cache(CWE_STATE_DIRECTORY)
 
-class CWEHandler(ContentHandler):
-    def __init__(self):
-        self.cwe = []
-        self.description_summary_tag = False
-        self.weakness_tag = False
-
-    def startElement(self, name, attrs):
-        if name == 'Weakness':
-            self.weakness_tag = True
-            self.statement = ""
-            self.weaknesses = attrs.get('Weakness_Abstraction')
-            self.name = attrs.get('Name')
-            self.idname = attrs.get('ID')
-            self.status = attrs.get('Status')
-            self.cwe.append({
-                'name': self.name,
-                'id': self.idname,
-                'status': self.status,
-                'weaknesses': self.weaknesses})
-        elif name == 'Description_Summary' and self.weakness_tag:
-            self.description_summary_tag = True
-            self.description_summary = ""
-
-    def characters(self, ch):
-        if self.description_summary_tag:
-            self.description_summary += ch.replace("       ", "")
-
-    def endElement(self, name):
-        if name == 'Description_Summary' and self.weakness_tag:
-            self.description_summary_tag = False
-            self.description_summary = self.description_summary + self.description_summary
-            self.cwe[-1]['description_summary'] = self.description_summary.replace("\n", "")
-        elif name == 'Weakness':
-            self.weakness_tag = False
+SOURCE_MODULE = '[{0}] :: '.format(get_module_name(__file__))
+PLUGIN_NAME = get_module_name(__file__)
 
 
 class UPDCWEThreadClass(Thread):
@@ -67,28 +43,100 @@ class UPDCWEThreadClass(Thread):
         self.callback_args = callback_args
 
     def target_with_callback(self):
-        self.method()
+        # One pooled connection per job, returned to the pool when the job ends.
+        with connection():
+            self.method()
         if self.callback is not None:
             self.callback(self.callback_args)
 
+def diff_cwe_records(records, state, seen):
+    """
+    Compare parsed records with hashes of the previous run.
+    Yield cache items for new and modified records only.
+    Fill `seen` with cwe_id -> content hash of every parsed record.
+    """
+    for cwe in records:
+        item = make_cwe_cache_item(cwe)
+        record_hash = content_key(cwe)
+        seen[cwe['id']] = record_hash
+        previous_hash = state.get(('record', cwe['id']), None)
+        if previous_hash is None:
+            item['state'] = 'new'
+            yield item
+        elif previous_hash != record_hash:
+            item['state'] = 'modified'
+            yield item
+
+
+def removed_cwe_ids(state, seen):
+    return [key[1] for key in state.iterkeys() if isinstance(key, tuple) and key[1] not in seen]
+
+
+def cache_and_publish_changes(items, batch_size):
+    """
+    Cache changed items in bounded batches and publish them to the new/modified queues.
+    Return counters by state. Raise IOError if a batch is not published,
+    so the caller does not save the hashes of unpublished changes.
+    """
+    queues = dict(
+        new=SETTINGS["queue"]["new_queue"],
+        modified=SETTINGS["queue"]["modified_queue"])
+    counters = dict(new=0, modified=0)
+    for batch in chunked(items, batch_size):
+        dc.extend_batched(batch, batch_size=batch_size)
+        for state, queue_name in queues.items():
+            changed = [item for item in batch if item['state'] == state]
+            if push_to_queue(queue_name, changed) != len(changed):
+                raise IOError('Can not publish {0} {1} CWE items to {2}'.format(len(changed), state, queue_name))
+            counters[state] += len(changed)
+    return counters
+
+
+def save_cwe_state(state, source_state, seen, removed):
+    with state.transact():
+        for cwe_id, record_hash in seen.items():
+            state.set(('record', cwe_id), record_hash)
+        for cwe_id in removed:
+            state.delete(('record', cwe_id))
+        state.set('source', source_state)
+
+
 def job_for_cwe_updater():
     LOGINFO_IF_ENABLED(SOURCE_MODULE, '[+] Start CWE updater job')
-    if check_internet_connection():
-        parser = make_parser()
-        cwe_handler = CWEHandler()
-        parser.setContentHandler(cwe_handler)
-        source = SETTINGS.get("cwe", {}).get("source", "http://cwe.mitre.org/data/xml/cwec_v2.8.xml.zip")
+    source = SETTINGS.get("cwe", {}).get("source", "http://cwe.mitre.org/data/xml/cwec_v2.8.xml.zip")
+    if connectivity.is_online(source):
+        batch_size = SETTINGS.get("cwe", {}).get("cache_batch_size", 500)
+        previous_source = cwe_state.get('source', None) or {}
         try:
             LOGINFO_IF_ENABLED(SOURCE_MODULE, '[+] Start downloading file')
-            data, response = get_file(getfile=source)
-            if 'error' not in response:
+            with Downloader() as downloader:
+                data, response = downloader.fetch_all(
+                    dict(cwe=source),
+                    headers=dict(cwe=make_conditional_headers(
+                        previous_source.get('etag'), previous_source.get('last_modified'))))['cwe']
+            if response == NOT_MODIFIED:
+                LOGINFO_IF_ENABLED(SOURCE_MODULE, '[+] CWE source is not modified, skip update')
+                return False
+            if data is not None:
+                source_state = dict(
+                    etag=response.headers.get('ETag'),
+                    last_modified=response.headers.get('Last-Modified'),
+                    sha256=response.sha256)
+                if source_state['sha256'] == previous_source.get('sha256'):
+                    cwe_state.set('source', source_state)
+                    LOGINFO_IF_ENABLED(SOURCE_MODULE, '[+] CWE source content is not changed, skip update')
+                    return False
                 LOGINFO_IF_ENABLED(SOURCE_MODULE, '[+] Start parsing CWE data')
-                parser.parse(data)
-                LOGINFO_IF_ENABLED(SOURCE_MODULE, '[+] Complete parsing CWE data')
-                for cwe in cwe_handler.cwe:
-                    cwe['description_summary'] = cwe['description_summary'].replace("\t\t\t\t\t", " ")
-                    item = {'tag': 'cwe', 'state':'parsed', 'data': cwe}
-                    dc.append(item)
+                seen = {}
+                counters = cache_and_publish_changes(
+                    diff_cwe_records(iter_cwe_weaknesses(data), cwe_state, seen), batch_size)
+                removed = removed_cwe_ids(cwe_state, seen)
+                dc.extend_batched(
+                    (make_cwe_cache_item({'id': cwe_id}, state='removed') for cwe_id in removed),
+                    batch_size=batch_size)
+                save_cwe_state(cwe_state, source_state, seen, removed)
+                LOGINFO_IF_ENABLED(SOURCE_MODULE, '[+] Complete parsing CWE data: {} new, {} modified, {} removed'.format(
+                    counters['new'], counters['modified'], len(removed)))
                 LOGINFO_IF_ENABLED(SOURCE_MODULE, "[===========================================================================]")
                 LOGINFO_IF_ENABLED(SOURCE_MODULE, '[+] CWE update complete at: {}'.format(datetime.utcnow()))
                 LOGINFO_IF_ENABLED(SOURCE_MODULE, "[===========================================================================]")
@@ -97,7 +145,7 @@ def job_for_cwe_updater():
                 LOGERR_IF_ENABLED(SOURCE_MODULE, '[-] There are some errors in server response: {}'.format(response))
                 return False
         except Exception as ex:
-            LOGERR_IF_ENABLED(SOURCE_MODULE, "Got exception during downloading CWE source: {0}".format(ex))
+            LOGERR_IF_ENABLED(SOURCE_MODULE, "Got exception during updating CWE: {0}".format(ex))
             return False
     else:
         LOGERR_IF_ENABLED(SOURCE_MODULE, '[-] No internet connection!')
@@ -105,7 +153,7 @@ def job_for_cwe_updater():
 
 def callback_for_cwe_updater_thread(args=[]):
     LOGINFO_IF_ENABLED(SOURCE_MODULE, '[+] Callback for CWE Updater complete job called with args: {}'.format(args))
-    LOGINFO_IF_ENABLED(SOURCE_MODULE, '[+] Diskcache size is: {}'.format(len(dc)))
+    LOGINFO_IF_ENABLED(SOURCE_MODULE, '[+] Diskcache volume is: {}'.format(dc.stats()))
 
 def start_cwe_updater_job(args):
     thr = UPDCWEThreadClass(
@@ -126,6 +174,7 @@ def start_cwe_updater_job(args):
 def main(args):
     if len(args) == 0:
         args = []
+        init_databases()
         start_cwe_updater_job(args)
     else:
         if condition:
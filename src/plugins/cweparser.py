@@ -0,0 +1,86 @@
+import os
+import sys
+from xml.sax import make_parser
+from xml.sax.handler import ContentHandler
+from collections import deque
+
+baseDir = os.path.dirname(os.path.abspath(os.path.dirname(__file__)))
+sys.path.append(baseDir)
+
+from settings import SETTINGS
+
+# CWE catalogue parsing shared by the CWE updater plugins and the benchmarks.
+# Importing this module opens no caches.
+
+
+class CWEHandler(ContentHandler):
+    """
+    SAX handler for the CWE catalogue.
+    Without `on_weakness` every parsed weakness is accumulated in `self.cwe`.
+    With `on_weakness` every weakness is handed to the callback as soon as
+    its </Weakness> closes and is not kept by the handler.
+    """
+
+    def __init__(self, on_weakness=None):
+        self.cwe = []
+        self.on_weakness = on_weakness
+        self.description_summary_tag = False
+        self.weakness_tag = False
+
+    def startElement(self, name, attrs):
+        if name == 'Weakness':
+            self.weakness_tag = True
+            self.statement = ""
+            self.weaknesses = attrs.get('Weakness_Abstraction')
+            self.name = attrs.get('Name')
+            self.idname = attrs.get('ID')
+            self.status = attrs.get('Status')
+            self.cwe.append({
+                'name': self.name,
+                'id': self.idname,
+                'status': self.status,
+                'weaknesses': self.weaknesses})
+        elif name == 'Description_Summary' and self.weakness_tag:
+            self.description_summary_tag = True
+            self.description_summary = ""
+
+    def characters(self, ch):
+        if self.description_summary_tag:
+            self.description_summary += ch.replace("       ", "")
+
+    def endElement(self, name):
+        if name == 'Description_Summary' and self.weakness_tag:
+            self.description_summary_tag = False
+            self.description_summary = self.description_summary + self.description_summary
+            self.cwe[-1]['description_summary'] = self.description_summary.replace("\n", "")
+        elif name == 'Weakness':
+            self.weakness_tag = False
+            if self.on_weakness is not None:
+                self.on_weakness(self.cwe.pop())
+
+
+def iter_cwe_weaknesses(data, chunk_size=None):
+    """
+    Feed CWE XML to an incremental SAX parser chunk by chunk
+    and yield every weakness right after its </Weakness> is parsed.
+    """
+    if chunk_size is None:
+        chunk_size = SETTINGS.get("cwe", {}).get("parser_chunk_size", 64 * 1024)
+    parsed = deque()
+    parser = make_parser()
+    parser.setContentHandler(CWEHandler(on_weakness=parsed.append))
+    while True:
+        chunk = data.read(chunk_size)
+        if not chunk:
+            break
+        parser.feed(chunk)
+        while parsed:
+            yield parsed.popleft()
+    parser.close()
+    while parsed:
+        yield parsed.popleft()
+
+
+def make_cwe_cache_item(cwe, state='parsed'):
+    cwe['description_summary'] = cwe.get('description_summary', '').replace("\t\t\t\t\t", " ")
+    return {'tag': 'cwe', 'state': state, 'data': cwe}
@@ -1,62 +1,431 @@
 import os
 import sys
-import json
 import zlib
+import struct
 import diskcache
+from functools import partial
 
 baseDir = os.path.dirname(os.path.abspath(os.path.dirname(__file__)))
 sys.path.append(baseDir)
 
+from logger import LOGINFO_IF_ENABLED, LOGWARN_IF_ENABLED
+from utils import get_module_name, chunked
+from dskcodecs import encode_value, decode_value, loads_value, content_key, get_codec, train_zdict, ZlibDictionaryStore, COMPRESSOR_ZLIB_DICT
+
+SOURCE_MODULE = '[{0}] :: '.format(get_module_name(__file__))
+
 CACHE_FOLDER = '/diskcache'
 CWE_FOLDER = '/cwe'
 TAG = u'cwe'
+INDEX_FOLDER = 'index'
+ARCHIVE_FOLDER = 'archive'
+ARCHIVE_FILE = 'spill.bin'
+ARCHIVE_ROTATED_SUFFIX = '.1'
+ARCHIVE_RECORD = struct.Struct('<I')
+# Consumer groups (see dskgroups) keep their state in <cache directory>/groups
+# and list their names under GROUPS_KEY there.
+GROUPS_FOLDER = 'groups'
+GROUPS_KEY = 'groups'
+
+EVICT_DROP_OLDEST = 'drop-oldest'
+EVICT_REJECT_NEW = 'reject-new'
+EVICT_SPILL_TO_ARCHIVE = 'spill-to-archive'
+EVICTION_POLICIES = (EVICT_DROP_OLDEST, EVICT_REJECT_NEW, EVICT_SPILL_TO_ARCHIVE)
 
-if not os.path.exists(os.path.join(baseDir, CACHE_FOLDER + CWE_FOLDER)):
-    LOGINFO_IF_ENABLED(SOURCE_MODULE, '[+] Create folder for diskcache')
-    os.makedirs(os.path.join(baseDir, CACHE_FOLDER + CWE_FOLDER))
+CWE_STATE_FOLDER = '/cwe_state'
+
+CWE_CACHE_DIRECTORY = baseDir + CACHE_FOLDER + CWE_FOLDER
+CWE_STATE_DIRECTORY = baseDir + CACHE_FOLDER + CWE_STATE_FOLDER
 
 
 # DequeDiskCache = diskcache.Deque()
 
+def compress_value(x, compress_level=1, codec='zlib', zdict=None):
+	return encode_value(x, codec, compress_level, zdict)
+
+def decompress_value(x, zdicts=None):
+	return decode_value(x, zdicts)
+
+def value_size(value):
+	if isinstance(value, (bytes, bytearray, memoryview, str)):
+		return len(value)
+	return 0
+
+def value_fingerprint(value):
+	if value is None:
+		return None
+	if not isinstance(value, (bytes, bytearray, memoryview)):
+		value = repr(value).encode('utf-8')
+	return zlib.crc32(value)
+
 class DequeDiskCache(diskcache.Deque):
-	def __init__(self, compress_level=1, **kwargs):
+	"""
+	diskcache.Deque that stores compressed JSON.
+	Every value carries a header byte naming its serializer and compressor
+	(see dskcodecs), so values written with different codecs can coexist.
+	With an `executor` (ThreadPoolExecutor or ProcessPoolExecutor) bulk methods
+	compress and decompress their items in parallel, preserving order.
+	With the zlib-dict codec a preset dictionary is trained from the first
+	extend_batched batch (or by train_zdict) and versioned in the cache directory.
+	With `index_key` ('hash' for a content hash or a callable such as
+	lambda item: item['data']['id']) a secondary index maps keys to stored
+	items, so contains/index/count/remove/get_by_key do not scan the deque.
+	With `max_items` and/or `max_bytes` (stored value bytes) the deque is bounded:
+	a push that crosses a limit either evicts the oldest items down to
+	`low_watermark` of the limits ('drop-oldest'), moves them to an append-only
+	archive file next to the cache ('spill-to-archive'), or is refused for the
+	items that do not fit ('reject-new'). stats() reports volume and counters.
+	With `max_archive_bytes` the archive is rotated once it would grow past it:
+	the previous rotated file is dropped, so the archive takes at most twice that.
+	While consumer groups are registered nothing is evicted, only 'reject-new' applies.
+	"""
+	def __init__(self, compress_level=1, codec='zlib', executor=None, executor_chunk_size=64, index_key=None,
+			max_items=None, max_bytes=None, eviction_policy=EVICT_DROP_OLDEST, low_watermark=0.9,
+			max_archive_bytes=None, **kwargs):
+		if eviction_policy not in EVICTION_POLICIES:
+			raise ValueError('Unknown eviction policy: {0}'.format(eviction_policy))
 		self.compress_level = compress_level
+		self.codec = get_codec(codec).name
+		self.executor = executor
+		self.executor_chunk_size = executor_chunk_size
+		self.written_bytes = 0
+		self.max_items = max_items
+		self.max_bytes = max_bytes
+		self.eviction_policy = eviction_policy
+		self.low_watermark = low_watermark
+		self.max_archive_bytes = max_archive_bytes
+		self.evicted = 0
+		self.rejected = 0
+		self.spilled = 0
 		super(DequeDiskCache, self).__init__(**kwargs)
+		self.zdicts = ZlibDictionaryStore(self.directory, compress_level)
+		self.index_key = content_key if index_key == 'hash' else index_key
+		self.key_index = None
+		if self.index_key is not None:
+			self.key_index = diskcache.Cache(os.path.join(self.directory, INDEX_FOLDER))
+		self.archive_path = os.path.join(self.directory, ARCHIVE_FOLDER, ARCHIVE_FILE)
+		self.stored_bytes = self._count_stored_bytes() if self.bounded else 0
+		self._groups_state = None
+	@property
+	def indexed(self):
+		return self.key_index is not None
+	@property
+	def bounded(self):
+		return self.max_items is not None or self.max_bytes is not None
+	def _count_stored_bytes(self):
+		(stored, ), = self._cache._sql(
+			'SELECT COALESCE(SUM(LENGTH(value)), 0) + COALESCE(SUM(size), 0) FROM Cache').fetchall()
+		return stored
+	def refresh_volume(self):
+		"""
+		Recount stored bytes from SQLite, e.g. after another process popped items.
+		"""
+		self.stored_bytes = self._count_stored_bytes()
+		return self.stored_bytes
+	def consumer_groups(self):
+		"""
+		Names of the consumer groups registered on this deque by any process.
+		"""
+		if self._groups_state is None:
+			directory = os.path.join(self.directory, GROUPS_FOLDER)
+			if not os.path.isdir(directory):
+				return ()
+			self._groups_state = diskcache.Cache(directory)
+		return tuple(self._groups_state.get(GROUPS_KEY, (), retry=True))
+	def _over(self, items, stored, scale=1.0):
+		return ((self.max_items is not None and items > self.max_items * scale) or
+			(self.max_bytes is not None and stored > self.max_bytes * scale))
+	def _admit(self, values, items):
+		"""
+		With 'reject-new' keep the leading values that fit into the limits.
+		"""
+		if self.eviction_policy != EVICT_REJECT_NEW:
+			return values, items
+		count = len(self._cache)
+		if self.max_bytes is not None and self.stored_bytes + sum(value_size(value) for value in values) > self.max_bytes:
+			self.refresh_volume()
+		stored = self.stored_bytes
+		admitted = 0
+		for value in values:
+			if self._over(count + admitted + 1, stored + value_size(value)):
+				break
+			stored += value_size(value)
+			admitted += 1
+		if admitted < len(values):
+			self.rejected += len(values) - admitted
+			LOGWARN_IF_ENABLED(SOURCE_MODULE, '[!] Cache is full, rejected {0} items'.format(len(values) - admitted))
+		return values[:admitted], items[:admitted]
+	def _evict(self):
+		"""
+		Pop the oldest items until the deque is within `low_watermark` of its limits.
+		Called inside the push transaction.
+		"""
+		if self.eviction_policy == EVICT_REJECT_NEW or not self._over(len(self._cache), self.stored_bytes):
+			return
+		if self.consumer_groups():
+			# Consumer groups remove items once all of them acknowledged them,
+			# evicting would drop items they have not seen.
+			LOGWARN_IF_ENABLED(SOURCE_MODULE, '[!] Cache is full, eviction is off while consumer groups are registered')
+			return
+		if self.max_bytes is not None:
+			self.refresh_volume()
+		evicted = []
+		while len(self._cache) and self._over(len(self._cache), self.stored_bytes, self.low_watermark):
+			try:
+				value = super(DequeDiskCache, self).popleft()
+			except IndexError:
+				break
+			self.stored_bytes -= value_size(value)
+			evicted.append(value)
+		if not evicted:
+			return
+		self.evicted += len(evicted)
+		if self.eviction_policy == EVICT_SPILL_TO_ARCHIVE:
+			self._spill(evicted)
+			self.spilled += len(evicted)
+		LOGWARN_IF_ENABLED(SOURCE_MODULE, '[!] Cache is full, {0} {1} oldest items'.format(
+			'spilled' if self.eviction_policy == EVICT_SPILL_TO_ARCHIVE else 'dropped', len(evicted)))
+	@property
+	def archive_paths(self):
+		"""
+		Archive files, oldest first.
+		"""
+		return [self.archive_path + ARCHIVE_ROTATED_SUFFIX, self.archive_path]
+	def archive_bytes(self):
+		return sum(os.path.getsize(path) for path in self.archive_paths if os.path.exists(path))
+	def _spill(self, values):
+		os.makedirs(os.path.dirname(self.archive_path), exist_ok=True)
+		records = []
+		for value in values:
+			if isinstance(value, str):
+				value = value.encode('utf-8')
+			elif not isinstance(value, (bytes, bytearray, memoryview)):
+				value = compress_value(value, self.compress_level, self.codec)
+			records.append(value)
+		archive = open(self.archive_path, 'ab')
+		try:
+			for value in records:
+				size = ARCHIVE_RECORD.size + len(value)
+				if (self.max_archive_bytes is not None and archive.tell() and
+						archive.tell() + size > self.max_archive_bytes):
+					archive.close()
+					os.replace(self.archive_path, self.archive_path + ARCHIVE_ROTATED_SUFFIX)
+					LOGWARN_IF_ENABLED(SOURCE_MODULE, '[!] Archive is full, rotated it and dropped the previous one')
+					archive = open(self.archive_path, 'ab')
+				archive.write(ARCHIVE_RECORD.pack(len(value)))
+				archive.write(value)
+		finally:
+			archive.close()
+	def iter_archive(self, compressed=True):
+		"""
+		Yield items spilled to the archive, oldest first.
+		"""
+		for path in self.archive_paths:
+			if not os.path.exists(path):
+				continue
+			with open(path, 'rb') as archive:
+				while True:
+					header = archive.read(ARCHIVE_RECORD.size)
+					if len(header) < ARCHIVE_RECORD.size:
+						break
+					value = archive.read(ARCHIVE_RECORD.unpack(header)[0])
+					yield self.decompress_data(value) if compressed else value
+	def clear_archive(self):
+		for path in self.archive_paths:
+			if os.path.exists(path):
+				os.remove(path)
+	def stats(self):
+		"""
+		Current volume and eviction counters.
+		"""
+		return dict(
+			items=len(self._cache),
+			stored_bytes=self.stored_bytes if self.bounded else self._count_stored_bytes(),
+			max_items=self.max_items,
+			max_bytes=self.max_bytes,
+			eviction_policy=self.eviction_policy,
+			evicted=self.evicted,
+			rejected=self.rejected,
+			spilled=self.spilled,
+			max_archive_bytes=self.max_archive_bytes,
+			archive_bytes=self.archive_bytes())
+	def _push_many(self, values, items, side='back'):
+		"""
+		Push already encoded values in one transaction and index them by their source items.
+		A bounded deque evicts or rejects items in the same transaction.
+		"""
+		values, items = list(values), list(items)
+		with self._cache.transact():
+			if self.bounded:
+				values, items = self._admit(values, items)
+			keys = [self._cache.push(value, side=side, retry=True) for value in values]
+			if self.bounded:
+				self.stored_bytes += sum(value_size(value) for value in values)
+				self._evict()
+		self.written_bytes += sum(len(value) for value in values if isinstance(value, (bytes, bytearray, memoryview)))
+		if self.indexed:
+			with self.key_index.transact():
+				for key, value, item in zip(keys, values, items):
+					index_key = self.index_key(item)
+					entry = (key, value_fingerprint(value))
+					self.key_index.set(index_key, self.key_index.get(index_key, ()) + (entry, ), retry=True)
+		return len(keys)
+	def _lookup(self, index_key):
+		"""
+		Return live deque keys stored under `index_key` in deque order.
+		Every entry keeps the fingerprint of the stored value, because the deque
+		reuses keys once it runs empty; entries of items that were popped
+		meanwhile, or whose key now holds another item, are dropped from the index.
+		"""
+		entries = self.key_index.get(index_key, ())
+		live = tuple(sorted(
+			entry for entry in entries
+			if isinstance(entry, tuple) and value_fingerprint(self._cache.get(entry[0], retry=True)) == entry[1]))
+		if live != entries:
+			if live:
+				self.key_index.set(index_key, live, retry=True)
+			else:
+				self.key_index.delete(index_key, retry=True)
+		return tuple(key for key, _ in live)
+	def _position(self, key):
+		(position, ), = self._cache._sql('SELECT COUNT(*) FROM Cache WHERE key < ? AND raw = 1', (key, )).fetchall()
+		return position
+	def rebuild_index(self):
+		"""
+		Rebuild the secondary index from the stored items.
+		Needed after operations that re-key the deque (reverse, rotate).
+		"""
+		if not self.indexed:
+			return
+		self.key_index.clear()
+		entries = {}
+		for key in self._cache.iterkeys():
+			value = self._cache.get(key, retry=True)
+			if value is None:
+				continue
+			index_key = self.index_key(loads_value(value, self.zdicts))
+			entries[index_key] = entries.get(index_key, ()) + ((key, value_fingerprint(value)), )
+		with self.key_index.transact():
+			for index_key, keys in entries.items():
+				self.key_index.set(index_key, keys, retry=True)
+	def contains(self, x):
+		if self.indexed:
+			return len(self._lookup(self.index_key(x))) > 0
+		return self.index(x, 0, len(self)) != -1
+	def get_by_key(self, index_key, compressed=True):
+		"""
+		Return the first stored item under a secondary index key or None.
+		"""
+		for key in self._lookup(index_key):
+			value = self._cache.get(key, retry=True)
+			if value is not None:
+				if compressed:
+					return self.decompress_data(value)
+				return value
+		return None
+	@property
+	def zdict(self):
+		if get_codec(self.codec).compressor_id != COMPRESSOR_ZLIB_DICT:
+			return None
+		return self.zdicts.latest
+	def train_zdict(self, samples):
+		"""
+		Train a new preset dictionary from sample records, store it as the next
+		version and use it for all further compressions. Return its version.
+		"""
+		return self.zdicts.add(train_zdict(samples)).version
 	def compress_data(self, x):
-		if isinstance(x, dict):
-			xbytes = json.dumps(x).encode('utf-8')
-		else:
-			xbytes = str(x).encode('utf-8')
-		return zlib.compress(xbytes, self.compress_level)
+		return compress_value(x, self.compress_level, self.codec, self.zdict)
 	def decompress_data(self, x):
-		if isinstance(x, bytes):
-			return zlib.decompress(x)
-		return x
+		return decompress_value(x, self.zdicts)
+	def compress_many(self, items):
+		if self.executor is None:
+			return [self.compress_data(i) for i in items]
+		return list(self.executor.map(
+			partial(compress_value, compress_level=self.compress_level, codec=self.codec, zdict=self.zdict),
+			items, chunksize=self.executor_chunk_size))
+	def decompress_many(self, items):
+		if self.executor is None:
+			return [self.decompress_data(i) for i in items]
+		return list(self.executor.map(
+			partial(decompress_value, zdicts=self.zdicts),
+			items, chunksize=self.executor_chunk_size))
 	def append(self, x, compressed=True):
+		if self.indexed or self.bounded:
+			self._push_many([self.compress_data(x) if compressed else x], [x])
+			return
 		if compressed:
 			return super(DequeDiskCache, self).append(self.compress_data(x))
 		return super(DequeDiskCache, self).append(x)
 	def appendleft(self, x, compressed=True):
+		if self.indexed or self.bounded:
+			self._push_many([self.compress_data(x) if compressed else x], [x], side='front')
+			return
 		if compressed:
 			return super(DequeDiskCache, self).appendleft(self.compress_data(x))
 		return super(DequeDiskCache, self).appendleft(x)
 	def clear(self):
-		return super(DequeDiskCache, self).clear()
+		if self.indexed:
+			self.key_index.clear()
+		result = super(DequeDiskCache, self).clear()
+		self.stored_bytes = 0
+		return result
 	def copy(self):
 		return super(DequeDiskCache, self).copy()
 	def count(self, x, compressed=True):
+		if self.indexed:
+			return len(self._lookup(self.index_key(x)))
 		if compressed:
 			return super(DequeDiskCache, self).count(self.compress_data(x))
 		return super(DequeDiskCache, self).count(x)
 	def extend(self, it, compressed=True):
+		if self.indexed or self.bounded:
+			items = list(it)
+			self._push_many(self.compress_many(items) if compressed else items, items)
+			return
 		if compressed:
-			return super(DequeDiskCache, self).extend([self.compress_data(i) for i in it])
+			return super(DequeDiskCache, self).extend(self.compress_many(list(it)))
 		return super(DequeDiskCache, self).extend(it)
+	def extend_batched(self, it, batch_size=500, compressed=True):
+		"""
+		Append items from any iterable, committing every `batch_size` items
+		in a single SQLite transaction. Return the number of written items.
+		"""
+		written = 0
+		for batch in chunked(it, batch_size):
+			written += self._push_many(self.encode_many(batch) if compressed else batch, batch)
+		return written
+	def encode_many(self, items):
+		"""
+		Compress items as extend_batched would store them, training the
+		preset dictionary first if the zlib-dict codec has none yet.
+		"""
+		items = list(items)
+		if self.zdict is None and get_codec(self.codec).compressor_id == COMPRESSOR_ZLIB_DICT:
+			self.train_zdict(items)
+		return self.compress_many(items)
+	def extend_encoded(self, values, items=None):
+		"""
+		Append values already encoded by encode_many; `items` are their
+		source items for the secondary index. Return the number of written items.
+		"""
+		values = [bytes(value) if isinstance(value, memoryview) else value for value in values]
+		return self._push_many(values, values if items is None else items)
 	def extendleft(self, it, compressed=True):
+		if self.indexed or self.bounded:
+			items = list(it)
+			self._push_many(self.compress_many(items) if compressed else items, items, side='front')
+			return
 		if compressed:
-			return super(DequeDiskCache, self).extendleft([self.compress_data(i) for i in it])
+			return super(DequeDiskCache, self).extendleft(self.compress_many(list(it)))
 		return super(DequeDiskCache, self).extendleft(it)
 	def index(self, x, start, stop, compressed=True):
+		if self.indexed:
+			for key in self._lookup(self.index_key(x)):
+				position = self._position(key)
+				if start <= position < stop:
+					return position
+			return -1
 		if compressed:
 			try:
 				result = super(DequeDiskCache, self).index(self.compress_data(x), start, stop)
@@ -69,43 +438,107 @@ class DequeDiskCache(diskcache.Deque):
 				result = -1
 		return result
 	def insert(self, position, x, compressed=True):
-		if compressed:
-			return super(DequeDiskCache, self).insert(position, self.compress_data(x))
-		return super(DequeDiskCache, self).insert(position, x)
+		value = self.compress_data(x) if compressed else x
+		if not self.bounded:
+			return super(DequeDiskCache, self).insert(position, value)
+		with self._cache.transact():
+			values, _ = self._admit([value], [x])
+			if not values:
+				return
+			result = super(DequeDiskCache, self).insert(position, value)
+			self.stored_bytes += value_size(value)
+			self._evict()
+		return result
+	def _released(self, value):
+		if self.bounded:
+			self.stored_bytes = max(0, self.stored_bytes - value_size(value))
+		return value
 	def pop(self, compressed=True):
 		if compressed:
 			try:
-				result = super(DequeDiskCache, self).pop()
+				result = self._released(super(DequeDiskCache, self).pop())
 				result = self.decompress_data(result)
 			except IndexError as ie:
 				result = None
 		else:
 			try:
-				result = super(DequeDiskCache, self).pop()
+				result = self._released(super(DequeDiskCache, self).pop())
 			except IndexError as ie:
 				result = None
 		return result
-	def popleft(self):
+	def popleft(self, compressed=True):
 		if compressed:
 			try:
-				result = super(DequeDiskCache, self).popleft()
+				result = self._released(super(DequeDiskCache, self).popleft())
 				result = self.decompress_data(result)
 			except IndexError as ie:
 				result = None
 		else:
 			try:
-				result = super(DequeDiskCache, self).popleft()
+				result = self._released(super(DequeDiskCache, self).popleft())
 			except IndexError as ie:
 				result = None
 		return result
-	def remove(self, x, compressed=True):
+	def _pop_raw_many(self, n, left):
+		pop = super(DequeDiskCache, self).popleft if left else super(DequeDiskCache, self).pop
+		result = []
+		with self._cache.transact():
+			for _ in range(n):
+				try:
+					result.append(self._released(pop()))
+				except IndexError:
+					break
+		return result
+	def pop_many(self, n, compressed=True):
+		"""
+		Pop up to `n` items from the back in one transaction.
+		Items are returned in pop order.
+		"""
+		result = self._pop_raw_many(n, left=False)
+		if compressed:
+			return self.decompress_many(result)
+		return result
+	def popleft_many(self, n, compressed=True):
+		"""
+		Pop up to `n` items from the front in one transaction.
+		Items are returned in pop order.
+		"""
+		result = self._pop_raw_many(n, left=True)
 		if compressed:
-			return super(DequeDiskCache, self).remove(self.compress_data(x))
-		return super(DequeDiskCache, self).remove(x)
+			return self.decompress_many(result)
+		return result
+	def pop_blobs(self, n):
+		"""
+		Pop up to `n` items from the back as memoryviews of the stored
+		encoded values, without decompressing them (see dskcodecs.is_portable).
+		"""
+		return [memoryview(value) for value in self._pop_raw_many(n, left=False)]
+	def popleft_blobs(self, n):
+		"""
+		Pop up to `n` items from the front as memoryviews of the stored encoded values.
+		"""
+		return [memoryview(value) for value in self._pop_raw_many(n, left=True)]
+	def remove(self, x, compressed=True):
+		if self.indexed:
+			for key in self._lookup(self.index_key(x)):
+				value = self._cache.pop(key, retry=True)
+				if value is not None:
+					self._released(value)
+					self._lookup(self.index_key(x))
+					return
+			raise ValueError('deque.remove(value): value not in deque')
+		value = self.compress_data(x) if compressed else x
+		result = super(DequeDiskCache, self).remove(value)
+		self._released(value)
+		return result
 	def reverse(self):
-		return super(DequeDiskCache, self).reverse()
+		result = super(DequeDiskCache, self).reverse()
+		self.rebuild_index()
+		return result
 	def rotate(self, n=1):
-		return super(DequeDiskCache, self).rotate(n)
+		result = super(DequeDiskCache, self).rotate(n)
+		self.rebuild_index()
+		return result
 
 # dd = DequeDiskCache()
 # dd.append('this is the string', compressed=False)
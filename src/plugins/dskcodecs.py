@@ -0,0 +1,385 @@
+import os
+import re
+import bz2
+import hashlib
+import json
+import lzma
+import zlib
+from collections import Counter
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Every encoded value starts with the 2-byte RECORD_MAGIC and one header byte:
+# high nibble - serializer, low nibble - compressor.
+# Values written before the header existed are plain zlib streams,
+# they always start with 0x78. Anything else (e.g. bytes stored with
+# compressed=False) is a raw value and is never decoded.
+RECORD_MAGIC = b'\xff\xdc'
+
+SERIALIZER_JSON = 1
+SERIALIZER_TEXT = 2
+SERIALIZER_BYTES = 3
+
+COMPRESSOR_NONE = 0
+COMPRESSOR_ZLIB = 1
+COMPRESSOR_BZ2 = 2
+COMPRESSOR_LZMA = 3
+COMPRESSOR_LZ4 = 4
+COMPRESSOR_ZSTD = 5
+COMPRESSOR_ZLIB_DICT = 6
+
+SERIALIZER_IDS = (SERIALIZER_JSON, SERIALIZER_TEXT, SERIALIZER_BYTES)
+COMPRESSOR_IDS = (
+    COMPRESSOR_NONE, COMPRESSOR_ZLIB, COMPRESSOR_BZ2,
+    COMPRESSOR_LZMA, COMPRESSOR_LZ4, COMPRESSOR_ZSTD, COMPRESSOR_ZLIB_DICT)
+
+LEGACY_ZLIB_HEADER = 0x78
+
+BLOB_TYPES = (bytes, bytearray, memoryview)
+
+# Pre-encoded values passed through Redis are framed as
+# \x00<content encoding>\x00<blob>, JSON text never starts with \x00.
+ENCODED_MARKER = b'\x00'
+CONTENT_ENCODING_DSK = 'dsk'
+
+# Values compressed with a preset dictionary are raw deflate streams
+# prefixed (after the header byte) with the 2-byte dictionary version.
+# A small window keeps priming and copying the compressor cheap.
+ZDICT_WBITS = -13
+ZDICT_MEM_LEVEL = 6
+ZDICT_SIZE = 1 << 13
+ZDICT_FOLDER = 'zdict'
+ZDICT_FILE_PATTERN = re.compile(r'^zdict\.(\d+)\.bin$')
+ZDICT_TOKEN_PATTERN = re.compile(rb'"\w+": "?|\w+(?:[ ,.]+\w+){0,2}')
+
+
+def _zstd_compress(data, level):
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def _zstd_decompress(data):
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+COMPRESSORS = {
+    COMPRESSOR_NONE: (lambda data, level: data, lambda data: data),
+    COMPRESSOR_ZLIB: (zlib.compress, zlib.decompress),
+    COMPRESSOR_BZ2: (lambda data, level: bz2.compress(data, max(level, 1)), bz2.decompress),
+    COMPRESSOR_LZMA: (lambda data, level: lzma.compress(data, preset=level), lzma.decompress),
+}
+if lz4_frame is not None:
+    COMPRESSORS[COMPRESSOR_LZ4] = (
+        lambda data, level: lz4_frame.compress(data, compression_level=level), lz4_frame.decompress)
+if zstandard is not None:
+    COMPRESSORS[COMPRESSOR_ZSTD] = (_zstd_compress, _zstd_decompress)
+
+
+class Codec(object):
+    """
+    Named compressor setup for DequeDiskCache.
+    Payloads shorter than `min_size` are stored uncompressed.
+    `level` overrides the compress level of the cache when set.
+    """
+
+    def __init__(self, name, compressor_id, level=None, min_size=0):
+        self.name = name
+        self.compressor_id = compressor_id
+        self.level = level
+        self.min_size = min_size
+
+    @property
+    def available(self):
+        return self.compressor_id in COMPRESSORS or self.compressor_id == COMPRESSOR_ZLIB_DICT
+
+    def __repr__(self):
+        return 'Codec({0})'.format(self.name)
+
+
+CODECS = {}
+
+
+def register_codec(codec):
+    CODECS[codec.name] = codec
+    return codec
+
+
+register_codec(Codec('none', COMPRESSOR_NONE))
+register_codec(Codec('zlib', COMPRESSOR_ZLIB))
+register_codec(Codec('zlib-fast', COMPRESSOR_ZLIB, level=1, min_size=256))
+register_codec(Codec('zlib-dict', COMPRESSOR_ZLIB_DICT))
+register_codec(Codec('bz2', COMPRESSOR_BZ2, level=9))
+register_codec(Codec('lzma', COMPRESSOR_LZMA, level=6))
+register_codec(Codec('lz4', COMPRESSOR_LZ4, level=0))
+register_codec(Codec('zstd', COMPRESSOR_ZSTD, level=3))
+
+
+def get_codec(name):
+    codec = CODECS.get(name, None)
+    if codec is None:
+        raise ValueError('Unknown codec: {0}'.format(name))
+    if not codec.available:
+        raise ValueError('Codec {0} is not available, install its package'.format(name))
+    return codec
+
+
+def available_codecs():
+    return [name for name, codec in CODECS.items() if codec.available]
+
+
+def serialize_value(x):
+    if isinstance(x, bytes):
+        return SERIALIZER_BYTES, x
+    if isinstance(x, (dict, list)):
+        return SERIALIZER_JSON, json.dumps(x).encode('utf-8')
+    return SERIALIZER_TEXT, str(x).encode('utf-8')
+
+
+class ZlibDictionary(object):
+    """
+    Versioned zlib preset dictionary.
+    Keeps a primed compressor and decompressor and copies them for every value,
+    so the dictionary is not re-hashed per record.
+    """
+
+    def __init__(self, version, data, compress_level=1):
+        self.version = version
+        self.data = data
+        self.compress_level = compress_level
+        self._compressor = zlib.compressobj(
+            compress_level, zlib.DEFLATED, ZDICT_WBITS, ZDICT_MEM_LEVEL, zdict=data)
+        self._decompressor = zlib.decompressobj(ZDICT_WBITS, zdict=data)
+
+    def compress(self, payload):
+        compressor = self._compressor.copy()
+        return compressor.compress(payload) + compressor.flush()
+
+    def decompress(self, body):
+        decompressor = self._decompressor.copy()
+        return decompressor.decompress(body) + decompressor.flush()
+
+    def __getstate__(self):
+        return self.version, self.data, self.compress_level
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+
+class ZlibDictionaryStore(dict):
+    """
+    Versioned preset dictionaries kept under <cache directory>/zdict.
+    Maps version to ZlibDictionary; unknown versions written by other
+    processes are picked up from disk on first access.
+    """
+
+    def __init__(self, directory, compress_level=1):
+        super(ZlibDictionaryStore, self).__init__()
+        self.directory = os.path.join(directory, ZDICT_FOLDER)
+        self.compress_level = compress_level
+        self.reload()
+
+    def reload(self):
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            match = ZDICT_FILE_PATTERN.match(name)
+            if match is None:
+                continue
+            version = int(match.group(1))
+            if not dict.__contains__(self, version):
+                with open(os.path.join(self.directory, name), 'rb') as zdict_file:
+                    self[version] = ZlibDictionary(version, zdict_file.read(), self.compress_level)
+
+    def __missing__(self, version):
+        self.reload()
+        if dict.__contains__(self, version):
+            return dict.__getitem__(self, version)
+        raise KeyError(version)
+
+    @property
+    def latest(self):
+        if not self:
+            return None
+        return dict.__getitem__(self, max(self.keys()))
+
+    def add(self, data):
+        """
+        Store a new dictionary under the next free version and return it.
+        """
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+        self.reload()
+        tmp_path = os.path.join(self.directory, 'zdict.{0}.tmp'.format(os.getpid()))
+        with open(tmp_path, 'wb') as zdict_file:
+            zdict_file.write(data)
+        version = max(self.keys()) + 1 if self else 1
+        try:
+            while True:
+                try:
+                    os.link(tmp_path, os.path.join(self.directory, 'zdict.{0}.bin'.format(version)))
+                    break
+                except FileExistsError:
+                    version += 1
+        finally:
+            os.remove(tmp_path)
+        if version > 0xFFFF:
+            raise ValueError('zlib dictionary versions are exhausted')
+        self[version] = ZlibDictionary(version, data, self.compress_level)
+        return self[version]
+
+
+def train_zdict(samples, size=ZDICT_SIZE):
+    """
+    Build a preset dictionary from sample records.
+    Keeps the key prefixes and short phrases that occur in most samples;
+    the most valuable ones go last, closest to the data in the window.
+    """
+    frequency = Counter()
+    for sample in samples:
+        _, payload = serialize_value(sample)
+        frequency.update(set(ZDICT_TOKEN_PATTERN.findall(payload)))
+    tokens = [token for token, count in frequency.items() if count > 1]
+    tokens.sort(key=lambda token: frequency[token] * len(token), reverse=True)
+    selected = []
+    total = 0
+    for token in tokens:
+        if total + len(token) > size:
+            continue
+        selected.append(token)
+        total += len(token)
+    return b''.join(reversed(selected))
+
+
+def content_key(x):
+    """
+    Stable content hash of a value, independent of dict key order and codec.
+    """
+    if isinstance(x, (dict, list)):
+        payload = json.dumps(x, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    else:
+        _, payload = serialize_value(x)
+    return hashlib.sha1(payload).hexdigest()
+
+
+def encode_value(x, codec='zlib', compress_level=1, zdict=None):
+    """
+    Serialize and compress `x`, prefixed with the header byte.
+    The zlib-dict codec falls back to plain zlib until a dictionary is trained.
+    """
+    codec = get_codec(codec)
+    serializer_id, payload = serialize_value(x)
+    compressor_id = codec.compressor_id
+    if len(payload) < codec.min_size:
+        compressor_id = COMPRESSOR_NONE
+    if compressor_id == COMPRESSOR_ZLIB_DICT:
+        if zdict is not None:
+            header = RECORD_MAGIC + bytes(((serializer_id << 4) | compressor_id, ))
+            return header + zdict.version.to_bytes(2, 'big') + zdict.compress(payload)
+        compressor_id = COMPRESSOR_ZLIB
+    level = compress_level if codec.level is None else codec.level
+    compress, _ = COMPRESSORS[compressor_id]
+    return RECORD_MAGIC + bytes(((serializer_id << 4) | compressor_id, )) + compress(payload, level)
+
+
+def split_header(x):
+    """
+    Return (serializer_id, compressor_id, body) for a stored value.
+    Legacy headerless zlib values are reported as JSON/zlib,
+    raw values as (None, None, x).
+    """
+    if len(x) > len(RECORD_MAGIC) and x[:len(RECORD_MAGIC)] == RECORD_MAGIC:
+        header = x[len(RECORD_MAGIC)]
+        return header >> 4, header & 0x0F, x[len(RECORD_MAGIC) + 1:]
+    if x[0] == LEGACY_ZLIB_HEADER:
+        return SERIALIZER_JSON, COMPRESSOR_ZLIB, x
+    return None, None, x
+
+
+def decode_value(x, zdicts=None):
+    """
+    Strip the header and decompress a stored value (bytes or a memoryview of them).
+    Return the serialized payload bytes. Values without RECORD_MAGIC (e.g. bytes
+    stored with compressed=False) are returned as is. `zdicts` maps dictionary versions to ZlibDictionary.
+    """
+    if not isinstance(x, BLOB_TYPES) or not x:
+        return x
+    serializer_id, compressor_id, body = split_header(x)
+    if serializer_id not in SERIALIZER_IDS or compressor_id not in COMPRESSOR_IDS:
+        return x
+    if compressor_id == COMPRESSOR_NONE:
+        return bytes(body)
+    if compressor_id == COMPRESSOR_ZLIB_DICT:
+        version = int.from_bytes(body[:2], 'big')
+        try:
+            zdict = zdicts[version]
+        except (KeyError, TypeError):
+            raise ValueError('Unknown zlib dictionary version: {0}'.format(version))
+        return zdict.decompress(body[2:])
+    if compressor_id not in COMPRESSORS:
+        raise ValueError('Compressor {0} is not available, install its package'.format(compressor_id))
+    _, decompress = COMPRESSORS[compressor_id]
+    if x[0] == LEGACY_ZLIB_HEADER:
+        try:
+            return decompress(body)
+        except zlib.error:
+            return x
+    return decompress(body)
+
+
+def loads_value(x, zdicts=None):
+    """
+    Decode a stored value back to the object it was made from.
+    """
+    if not isinstance(x, BLOB_TYPES) or not x:
+        return x
+    serializer_id, compressor_id, _ = split_header(x)
+    if serializer_id not in SERIALIZER_IDS or compressor_id not in COMPRESSOR_IDS:
+        return x
+    payload = decode_value(x, zdicts)
+    if payload is x:
+        return x
+    if serializer_id == SERIALIZER_JSON:
+        return json.loads(payload.decode('utf-8'))
+    if serializer_id == SERIALIZER_TEXT:
+        return payload.decode('utf-8')
+    return payload
+
+
+def is_portable(x):
+    """
+    True if a stored value can be decoded without the cache directory,
+    i.e. it has a known header and does not need a zlib preset dictionary.
+    """
+    if not isinstance(x, BLOB_TYPES) or not x:
+        return False
+    serializer_id, compressor_id, _ = split_header(x)
+    return serializer_id in SERIALIZER_IDS and compressor_id in COMPRESSORS
+
+
+def frame_encoded(x, content_encoding=CONTENT_ENCODING_DSK):
+    """
+    Prefix a pre-encoded value with its content-encoding marker for Redis.
+    """
+    return b''.join((ENCODED_MARKER, content_encoding.encode('ascii'), ENCODED_MARKER, x))
+
+
+def is_framed(raw):
+    return isinstance(raw, BLOB_TYPES) and raw[:1] == ENCODED_MARKER
+
+
+def loads_framed(raw, zdicts=None):
+    """
+    Decode a value written by frame_encoded back to the object it was made from.
+    """
+    content_encoding, _, body = bytes(raw[1:]).partition(ENCODED_MARKER)
+    content_encoding = content_encoding.decode('ascii')
+    if content_encoding != CONTENT_ENCODING_DSK:
+        raise ValueError('Unknown content encoding: {0}'.format(content_encoding))
+    return loads_value(body, zdicts)
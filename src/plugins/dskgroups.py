@@ -0,0 +1,291 @@
+import os
+import sys
+import time
+import socket
+import diskcache
+
+baseDir = os.path.dirname(os.path.abspath(os.path.dirname(__file__)))
+sys.path.append(baseDir)
+sys.path.append(os.path.join(baseDir, 'plugins'))
+
+from settings import SETTINGS
+from logger import LOGINFO_IF_ENABLED, LOGWARN_IF_ENABLED
+from utils import get_module_name
+from dskcache import GROUPS_FOLDER, GROUPS_KEY
+
+SOURCE_MODULE = '[{0}] :: '.format(get_module_name(__file__))
+
+GROUP_KEY = 'group'
+DEAD_KEY = 'dead'
+SEQUENCE_KEY = 'sequence'
+
+
+def default_consumer():
+    return '{0}:{1}'.format(socket.gethostname(), os.getpid())
+
+
+class ConsumerGroup(object):
+    """
+    Consumer group over a DequeDiskCache: several processes claim batches
+    of items without removing them, and an item is removed only after
+    every group has acknowledged it.
+    claim() leases up to `n` items to a consumer for `lease_timeout` seconds;
+    items whose lease expired before ack() are delivered again, first.
+    An item delivered more than `max_deliveries` times is moved to the
+    group's dead letters (see dead_letters()) instead.
+    Items are numbered by a sequence shared by all groups when a group first
+    reaches them; the number is stored as the item tag in the deque, so it does
+    not depend on deque keys, which diskcache reuses once the deque is empty.
+    Group state (cursor and leases by sequence) lives in a diskcache.Cache in
+    the deque directory and is changed in SQLite transactions, always taking
+    the deque lock first, so consumers may live in different processes.
+    Items popped directly bypass the groups, rotate() and reverse() give the
+    moved items new numbers, and while any group is registered
+    the deque evicts nothing (see DequeDiskCache.consumer_groups()).
+    """
+
+    def __init__(self, cache, name, lease_timeout=None, max_deliveries=None):
+        settings = SETTINGS.get("cwe", {})
+        self.cache = cache
+        self.name = name
+        self.lease_timeout = lease_timeout or settings.get("group_lease_timeout_in_sec", 300)
+        self.max_deliveries = max_deliveries or settings.get("group_max_deliveries", None)
+        self.state = diskcache.Cache(os.path.join(cache.directory, GROUPS_FOLDER))
+        self.cache._cache.create_tag_index()
+        with self.cache._cache.transact(), self.state.transact():
+            if self.state.get((GROUP_KEY, name), retry=True) is None:
+                self.state.set((GROUP_KEY, name), self._new_state(), retry=True)
+                LOGINFO_IF_ENABLED(SOURCE_MODULE, '[+] Created consumer group {0}'.format(name))
+            groups = self._groups()
+            if name not in groups:
+                self.state.set(GROUPS_KEY, groups + [name], retry=True)
+
+    @staticmethod
+    def _new_state():
+        # cursor: last sequence delivered to the group;
+        # pending: sequence -> [consumer, lease deadline, deliveries, deque key].
+        return dict(cursor=0, pending={}, delivered=0, redelivered=0, acked=0, dead=0)
+
+    def _load(self):
+        return self.state.get((GROUP_KEY, self.name), retry=True) or self._new_state()
+
+    def _save(self, state):
+        self.state.set((GROUP_KEY, self.name), state, retry=True)
+
+    def _groups(self):
+        return list(self.state.get(GROUPS_KEY, (), retry=True))
+
+    def _after(self, cursor, n):
+        """
+        (sequence, deque key) of up to `n` items numbered after `cursor`.
+        """
+        rows = self.cache._cache._sql(
+            'SELECT tag, key FROM Cache WHERE raw = 1 AND tag > ? ORDER BY tag LIMIT ?', (cursor, n)).fetchall()
+        return rows
+
+    def _number(self, n):
+        """
+        Give the next sequence numbers to up to `n` items no group has reached yet, in deque order.
+        Runs inside the deque and state transactions; return the number of items numbered.
+        """
+        rowids = [rowid for rowid, in self.cache._cache._sql(
+            'SELECT rowid FROM Cache WHERE raw = 1 AND tag IS NULL ORDER BY key LIMIT ?', (n, )).fetchall()]
+        if not rowids:
+            return 0
+        last = self.state.incr(SEQUENCE_KEY, len(rowids), default=0, retry=True)
+        for sequence, rowid in enumerate(rowids, last - len(rowids) + 1):
+            self.cache._cache._sql('UPDATE Cache SET tag = ? WHERE rowid = ?', (sequence, rowid))
+        return len(rowids)
+
+    def _get(self, sequence, key):
+        # The deque key may hold another item once the deque was emptied.
+        value, tag = self.cache._cache.get(key, tag=True, retry=True)
+        return value if tag == sequence else None
+
+    def _decode(self, values, compressed):
+        if compressed:
+            return self.cache.decompress_many(values)
+        return values
+
+    def claim(self, n, consumer=None, compressed=True):
+        """
+        Lease up to `n` items to `consumer` (host:pid by default).
+        Expired leases are redelivered before new items.
+        Return a list of (sequence, item); pass the sequences to ack() or nack().
+        """
+        consumer = consumer or default_consumer()
+        now = time.time()
+        deadline = now + self.lease_timeout
+        claimed = []
+        with self.cache._cache.transact(), self.state.transact():
+            state = self._load()
+            pending = state["pending"]
+            changed = False
+            expired = sorted(sequence for sequence, lease in pending.items() if lease[1] <= now)
+            for sequence in expired:
+                if len(claimed) >= n:
+                    break
+                lease = pending[sequence]
+                value = self._get(sequence, lease[3])
+                changed = True
+                if value is None:
+                    del pending[sequence]
+                    continue
+                if self.max_deliveries is not None and lease[2] >= self.max_deliveries:
+                    del pending[sequence]
+                    self.state.set((DEAD_KEY, self.name, sequence), value, retry=True)
+                    state["dead"] += 1
+                    LOGWARN_IF_ENABLED(SOURCE_MODULE, '[!] Group {0}: item {1} moved to dead letters after {2} deliveries'.format(
+                        self.name, sequence, lease[2]))
+                    continue
+                pending[sequence] = [consumer, deadline, lease[2] + 1, lease[3]]
+                state["redelivered"] += 1
+                claimed.append((sequence, value))
+            while len(claimed) < n:
+                rows = self._after(state["cursor"], n - len(claimed))
+                if not rows:
+                    if self._number(n - len(claimed)):
+                        continue
+                    break
+                state["cursor"] = rows[-1][0]
+                changed = True
+                for sequence, key in rows:
+                    value = self.cache._cache.get(key, retry=True)
+                    if value is None:
+                        continue
+                    pending[sequence] = [consumer, deadline, 1, key]
+                    state["delivered"] += 1
+                    claimed.append((sequence, value))
+            if changed:
+                self._save(state)
+        sequences = [sequence for sequence, _ in claimed]
+        return list(zip(sequences, self._decode([value for _, value in claimed], compressed)))
+
+    def ack(self, sequences, consumer=None):
+        """
+        Acknowledge processed items and remove those that every group has acknowledged.
+        Items leased to another consumer meanwhile (after an expired lease) are skipped.
+        Return the number of acknowledged items.
+        """
+        acked = 0
+        with self.cache._cache.transact(), self.state.transact():
+            state = self._load()
+            pending = state["pending"]
+            for sequence in sequences:
+                lease = pending.get(sequence)
+                if lease is None or (consumer is not None and lease[0] != consumer):
+                    continue
+                del pending[sequence]
+                acked += 1
+            if acked:
+                state["acked"] += acked
+                self._save(state)
+                self._trim()
+        return acked
+
+    def nack(self, sequences, consumer=None):
+        """
+        Release leases so the items are delivered again by the next claim().
+        Return the number of released items.
+        """
+        released = 0
+        with self.state.transact():
+            state = self._load()
+            for sequence in sequences:
+                lease = state["pending"].get(sequence)
+                if lease is None or (consumer is not None and lease[0] != consumer):
+                    continue
+                lease[1] = 0
+                released += 1
+            if released:
+                self._save(state)
+        return released
+
+    def renew(self, sequences, consumer=None):
+        """
+        Extend leases of items still held by `consumer` by lease_timeout.
+        Return the number of renewed leases.
+        """
+        deadline = time.time() + self.lease_timeout
+        renewed = 0
+        with self.state.transact():
+            state = self._load()
+            for sequence in sequences:
+                lease = state["pending"].get(sequence)
+                if lease is None or (consumer is not None and lease[0] != consumer):
+                    continue
+                lease[1] = deadline
+                renewed += 1
+            if renewed:
+                self._save(state)
+        return renewed
+
+    def _low_watermark(self, state):
+        """
+        First sequence the group may still need.
+        """
+        if state["pending"]:
+            return min(state["pending"])
+        return state["cursor"] + 1
+
+    def _trim(self):
+        # Runs inside the deque and state transactions of ack().
+        marks = [self._low_watermark(self.state.get((GROUP_KEY, name), retry=True) or self._new_state())
+                 for name in self._groups()]
+        if not marks:
+            return 0
+        rows = self.cache._cache._sql(
+            'SELECT key FROM Cache WHERE raw = 1 AND tag < ? ORDER BY tag', (min(marks), )).fetchall()
+        trimmed = 0
+        for key, in rows:
+            value = self.cache._cache.pop(key, retry=True)
+            if value is not None:
+                self.cache._released(value)
+                trimmed += 1
+        return trimmed
+
+    def dead_letters(self, compressed=True):
+        """
+        Iterate (sequence, item) of items that exceeded max_deliveries.
+        """
+        for key in list(self.state.iterkeys()):
+            if isinstance(key, tuple) and key[:2] == (DEAD_KEY, self.name):
+                value = self.state.get(key, retry=True)
+                if value is not None:
+                    yield key[2], self.cache.decompress_data(value) if compressed else value
+
+    def clear_dead_letters(self):
+        for key in list(self.state.iterkeys()):
+            if isinstance(key, tuple) and key[:2] == (DEAD_KEY, self.name):
+                self.state.delete(key, retry=True)
+
+    def lag(self):
+        """
+        Number of items the group has not reached yet.
+        """
+        cursor = self._load()["cursor"]
+        (count, ), = self.cache._cache._sql(
+            'SELECT COUNT(*) FROM Cache WHERE raw = 1 AND (tag IS NULL OR tag > ?)', (cursor, )).fetchall()
+        return count
+
+    def stats(self):
+        state = self._load()
+        now = time.time()
+        return dict(
+            group=self.name,
+            pending=len(state["pending"]),
+            expired=sum(1 for lease in state["pending"].values() if lease[1] <= now),
+            lag=self.lag(),
+            delivered=state["delivered"],
+            redelivered=state["redelivered"],
+            acked=state["acked"],
+            dead=state["dead"])
+
+    def destroy(self):
+        """
+        Remove the group with its leases and dead letters, so it no longer holds back trimming.
+        """
+        with self.cache._cache.transact(), self.state.transact():
+            self.clear_dead_letters()
+            self.state.delete((GROUP_KEY, self.name), retry=True)
+            self.state.set(GROUPS_KEY, [name for name in self._groups() if name != self.name], retry=True)
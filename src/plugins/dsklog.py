@@ -0,0 +1,472 @@
+import os
+import sys
+import mmap
+import zlib
+import fcntl
+import struct
+import threading
+from contextlib import contextmanager
+
+baseDir = os.path.dirname(os.path.abspath(os.path.dirname(__file__)))
+sys.path.append(baseDir)
+
+from settings import SETTINGS
+from logger import LOGINFO_IF_ENABLED, LOGERR_IF_ENABLED
+from utils import get_module_name, chunked
+from dskcodecs import get_codec, train_zdict, ZlibDictionaryStore, COMPRESSOR_ZLIB_DICT, BLOB_TYPES
+from dskcache import DequeDiskCache, compress_value, decompress_value, CACHE_FOLDER, CWE_CACHE_DIRECTORY
+
+SOURCE_MODULE = '[{0}] :: '.format(get_module_name(__file__))
+
+CWE_LOG_FOLDER = '/cwe_log'
+CWE_LOG_DIRECTORY = baseDir + CACHE_FOLDER + CWE_LOG_FOLDER
+
+SEGMENT_FOLDER = 'segments'
+SEGMENT_SUFFIX = '.seg'
+CURSOR_FILE = 'cursor'
+LOCK_FILE = 'lock'
+
+# Every record is <length:u32><crc32:u32><encoded value>.
+RECORD_HEADER = struct.Struct('<II')
+# The cursor file has two slots written in turn by a write generation that
+# only grows (the read sequence may go back on a rewind), so a torn write
+# leaves the other one valid:
+# <generation:u64><sequence:u64><segment:u64><offset:u64><crc32:u32>.
+CURSOR_SLOT = struct.Struct('<QQQQI')
+
+
+def segment_name(base):
+    return '{0:020d}{1}'.format(base, SEGMENT_SUFFIX)
+
+
+class SegmentLogCache(object):
+    """
+    Append-only log of length-prefixed encoded records split into segments,
+    with the DequeDiskCache API for FIFO staging (append, extend, extend_batched,
+    popleft, popleft_many, len, iteration, stats).
+    Values are encoded with the same codecs and header byte as DequeDiskCache.
+    Records are read through mmap; popping only advances a read cursor persisted
+    in the cache directory, and segments behind the cursor are removed by compact(),
+    which a background thread runs every `compact_interval` seconds.
+    Segments are named by the sequence number of their first record.
+    Operations take an fcntl lock on the directory, so producers and consumers
+    may live in different processes.
+    Popped records can be put back only by extendleft of the last popleft_many
+    result, which rewinds the cursor; pop from the back, insert, remove,
+    rotate and reverse are not supported by a log.
+    """
+
+    def __init__(self, directory=CWE_LOG_DIRECTORY, compress_level=1, codec='zlib', executor=None,
+                 executor_chunk_size=64, segment_size=None, compact_interval=None, fsync=False):
+        settings = SETTINGS.get("cwe", {})
+        self.directory = directory
+        self.compress_level = compress_level
+        self.codec = get_codec(codec).name
+        self.executor = executor
+        self.executor_chunk_size = executor_chunk_size
+        self.segment_size = segment_size or settings.get("log_segment_size", 64 * 1024 * 1024)
+        self.compact_interval = compact_interval if compact_interval is not None else \
+            settings.get("log_compact_interval_in_sec", 60)
+        self.fsync = fsync
+        self.written_bytes = 0
+        self.segments_directory = os.path.join(directory, SEGMENT_FOLDER)
+        os.makedirs(self.segments_directory, exist_ok=True)
+        self.zdicts = ZlibDictionaryStore(directory, compress_level)
+        self._lock = threading.RLock()
+        self._lock_file = open(os.path.join(directory, LOCK_FILE), 'a+b')
+        self._cursor_file = os.path.join(directory, CURSOR_FILE)
+        self._maps = {}
+        self._segments = []
+        self._tail = None
+        self._cursor = None
+        self._generation = 0
+        self._last_read = None
+        self._stop = threading.Event()
+        self._compactor = None
+        with self._locked():
+            self._refresh()
+        if self.compact_interval > 0:
+            self._compactor = threading.Thread(target=self._compact_forever, name='SegmentLogCompactor', daemon=True)
+            self._compactor.start()
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _segment_path(self, base):
+        return os.path.join(self.segments_directory, segment_name(base))
+
+    def _list_segments(self):
+        return sorted(
+            int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.segments_directory)
+            if name.endswith(SEGMENT_SUFFIX))
+
+    def _map(self, base):
+        """
+        Return an mmap of the segment covering everything written so far.
+        """
+        path = self._segment_path(base)
+        size = os.path.getsize(path)
+        mapped = self._maps.get(base)
+        if mapped is not None and len(mapped) >= size:
+            return mapped
+        if mapped is not None:
+            self._unmap(base)
+        if size == 0:
+            return None
+        with open(path, 'rb') as segment:
+            mapped = self._maps[base] = mmap.mmap(segment.fileno(), size, access=mmap.ACCESS_READ)
+        return mapped
+
+    def _unmap(self, base):
+        mapped = self._maps.pop(base, None)
+        if mapped is not None:
+            try:
+                mapped.close()
+            except BufferError:
+                # A memoryview of the segment is still alive, let it go with the view.
+                pass
+
+    def _scan(self, base, offset=0, count=0):
+        """
+        Walk valid records of a segment from `offset`.
+        Return (end offset, records) of the valid prefix.
+        """
+        mapped = self._map(base)
+        if mapped is None:
+            return 0, 0
+        size = len(mapped)
+        while offset + RECORD_HEADER.size <= size:
+            length, crc = RECORD_HEADER.unpack_from(mapped, offset)
+            end = offset + RECORD_HEADER.size + length
+            if end > size or zlib.crc32(mapped[offset + RECORD_HEADER.size:end]) != crc:
+                break
+            offset = end
+            count += 1
+        return offset, count
+
+    def _refresh(self):
+        """
+        Pick up segments and records written by other processes and the persisted cursor.
+        Called under the lock.
+        """
+        segments = self._list_segments()
+        if not segments:
+            start = self._cursor[0] if self._cursor is not None else 0
+            open(self._segment_path(start), 'ab').close()
+            segments = [start]
+        for base in set(self._maps) - set(segments):
+            self._unmap(base)
+        last = segments[-1]
+        if self._tail is not None and self._tail[1] == last:
+            end, count = self._scan(last, self._tail[2], self._tail[0] - last)
+        else:
+            end, count = self._scan(last)
+        if end < os.path.getsize(self._segment_path(last)):
+            # A torn write of a crashed producer; writers hold the lock, so nobody is mid-write now.
+            LOGERR_IF_ENABLED(SOURCE_MODULE, '[-] Truncate torn tail of segment {0} at {1}'.format(last, end))
+            self._unmap(last)
+            os.truncate(self._segment_path(last), end)
+        self._segments = segments
+        self._tail = (last + count, last, end)
+        self._generation, self._cursor = self._load_cursor()
+
+    def _load_cursor(self):
+        """
+        Return (generation, cursor) of the newest valid slot.
+        """
+        first = self._segments[0]
+        generation, best = 0, None
+        if os.path.exists(self._cursor_file):
+            with open(self._cursor_file, 'rb') as cursor_file:
+                data = cursor_file.read(CURSOR_SLOT.size * 2)
+            for slot in range(len(data) // CURSOR_SLOT.size):
+                slot_generation, sequence, base, offset, crc = CURSOR_SLOT.unpack_from(data, slot * CURSOR_SLOT.size)
+                if zlib.crc32(CURSOR_SLOT.pack(slot_generation, sequence, base, offset, 0)) != crc:
+                    continue
+                if best is None or slot_generation > generation:
+                    generation, best = slot_generation, (sequence, base, offset)
+        if best is None or best[1] < first:
+            best = (first, first, 0)
+        return generation, best
+
+    def _save_cursor(self, cursor):
+        generation = self._generation + 1
+        sequence, base, offset = cursor
+        slot = CURSOR_SLOT.pack(generation, sequence, base, offset,
+                                zlib.crc32(CURSOR_SLOT.pack(generation, sequence, base, offset, 0)))
+        fd = os.open(self._cursor_file, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.pwrite(fd, slot, (generation % 2) * CURSOR_SLOT.size)
+            if self.fsync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+        self._generation = generation
+        self._cursor = cursor
+
+    def _append_values(self, values):
+        """
+        Append encoded values to the tail segment, rolling over to a new segment
+        once it reaches `segment_size`. Called under the lock.
+        """
+        sequence, base, offset = self._tail
+        segment = open(self._segment_path(base), 'ab')
+        try:
+            for value in values:
+                if offset >= self.segment_size:
+                    self._close_segment(segment)
+                    base, offset = sequence, 0
+                    self._segments.append(base)
+                    segment = open(self._segment_path(base), 'ab')
+                segment.write(RECORD_HEADER.pack(len(value), zlib.crc32(value)))
+                segment.write(value)
+                offset += RECORD_HEADER.size + len(value)
+                sequence += 1
+                self.written_bytes += len(value)
+        finally:
+            self._close_segment(segment)
+        self._tail = (sequence, base, offset)
+        return len(values)
+
+    def _close_segment(self, segment):
+        segment.flush()
+        if self.fsync:
+            os.fsync(segment.fileno())
+        segment.close()
+
+    def _read(self, n, cursor=None, views=False):
+        """
+        Read up to `n` records from `cursor` (the read cursor by default).
+        Return (values, cursor after them).
+        Values are copied out of the map, or with `views` are memoryviews of
+        the map itself; a view keeps its map open after compaction.
+        """
+        sequence, base, offset = cursor or self._cursor
+        values = []
+        while len(values) < n and sequence < self._tail[0]:
+            mapped = self._map(base)
+            if mapped is None or offset >= len(mapped):
+                following = [segment for segment in self._segments if segment > base]
+                if not following:
+                    break
+                base, offset = following[0], 0
+                continue
+            length, _ = RECORD_HEADER.unpack_from(mapped, offset)
+            start = offset + RECORD_HEADER.size
+            values.append(memoryview(mapped)[start:start + length] if views else mapped[start:start + length])
+            offset = start + length
+            sequence += 1
+        return values, (sequence, base, offset)
+
+    def _pop_raw_many(self, n, views=False):
+        with self._locked():
+            self._refresh()
+            values, cursor = self._read(n, views=views)
+            if values:
+                self._last_read = (self._cursor, cursor, sorted(zlib.crc32(value) for value in values))
+                self._save_cursor(cursor)
+        return values
+
+    @property
+    def zdict(self):
+        if get_codec(self.codec).compressor_id != COMPRESSOR_ZLIB_DICT:
+            return None
+        return self.zdicts.latest
+
+    def train_zdict(self, samples):
+        return self.zdicts.add(train_zdict(samples)).version
+
+    def compress_data(self, x):
+        return compress_value(x, self.compress_level, self.codec, self.zdict)
+
+    def decompress_data(self, x):
+        return decompress_value(x, self.zdicts)
+
+    compress_many = DequeDiskCache.compress_many
+    decompress_many = DequeDiskCache.decompress_many
+    encode_many = DequeDiskCache.encode_many
+
+    def _encoded(self, items, compressed):
+        if compressed:
+            return self.compress_many(items)
+        return [item if isinstance(item, BLOB_TYPES) else str(item).encode('utf-8') for item in items]
+
+    def append(self, x, compressed=True):
+        self.extend([x], compressed)
+
+    def extend(self, it, compressed=True):
+        values = self._encoded(list(it), compressed)
+        with self._locked():
+            self._refresh()
+            return self._append_values(values)
+
+    def extend_batched(self, it, batch_size=500, compressed=True):
+        """
+        Append items from any iterable, writing every `batch_size` items at once.
+        Return the number of written items.
+        """
+        written = 0
+        for batch in chunked(it, batch_size):
+            written += self.extend(self.encode_many(batch) if compressed else batch, compressed=False)
+        return written
+
+    def extend_encoded(self, values, items=None):
+        """
+        Append values already encoded by encode_many. Return the number of written items.
+        """
+        return self.extend(values, compressed=False)
+
+    def extendleft(self, it, compressed=True):
+        """
+        Undo the last popleft_many: rewind the cursor if `it` holds the items it
+        returned (in either order, as restored by drain_cwe_cache) and nothing
+        was read after them. Anything else raises ValueError and leaves the cursor as is,
+        because an append-only log can not put other items to its front.
+        """
+        values = self._encoded(list(it), compressed)
+        with self._locked():
+            self._refresh()
+            if (self._last_read is None or self._last_read[1] != self._cursor or
+                    self._last_read[2] != sorted(zlib.crc32(value) for value in values)):
+                raise ValueError('An append-only log can only put back the last popleft_many result')
+            self._save_cursor(self._last_read[0])
+            self._last_read = None
+
+    def popleft(self, compressed=True):
+        values = self._pop_raw_many(1)
+        if not values:
+            return None
+        return self.decompress_data(values[0]) if compressed else values[0]
+
+    def popleft_many(self, n, compressed=True):
+        """
+        Read up to `n` items from the front and move the cursor past them.
+        Items are returned in pop order.
+        """
+        values = self._pop_raw_many(n)
+        if compressed:
+            return self.decompress_many(values)
+        return values
+
+    def popleft_blobs(self, n):
+        """
+        Read up to `n` items from the front as memoryviews of their encoded
+        records in the segment map (no copy, no decompression) and move the cursor past them.
+        """
+        return self._pop_raw_many(n, views=True)
+
+    def peekleft_many(self, n, compressed=True):
+        """
+        Read up to `n` items from the front without moving the cursor.
+        """
+        with self._locked():
+            self._refresh()
+            values, _ = self._read(n)
+        if compressed:
+            return self.decompress_many(values)
+        return values
+
+    def __len__(self):
+        with self._locked():
+            self._refresh()
+            return self._tail[0] - self._cursor[0]
+
+    def __iter__(self):
+        cursor = None
+        while True:
+            with self._locked():
+                self._refresh()
+                if cursor is None or cursor[1] not in self._segments:
+                    cursor = self._cursor
+                values, cursor = self._read(self.executor_chunk_size, cursor)
+            if not values:
+                return
+            for value in values:
+                yield self.decompress_data(value)
+
+    def clear(self):
+        """
+        Skip everything written so far; the segments are removed by compaction.
+        """
+        with self._locked():
+            self._refresh()
+            self._save_cursor(self._tail)
+            self._last_read = None
+        self.compact()
+
+    def compact(self):
+        """
+        Remove segments that lie entirely behind the read cursor.
+        Return the number of removed segments.
+        """
+        removed = 0
+        with self._locked():
+            self._refresh()
+            for base in list(self._segments[:-1]):
+                if base >= self._cursor[1]:
+                    break
+                self._unmap(base)
+                os.remove(self._segment_path(base))
+                self._segments.remove(base)
+                removed += 1
+        if removed:
+            LOGINFO_IF_ENABLED(SOURCE_MODULE, '[+] Compacted {0} consumed segments'.format(removed))
+        return removed
+
+    def _compact_forever(self):
+        while not self._stop.wait(self.compact_interval):
+            try:
+                self.compact()
+            except Exception as ex:
+                LOGERR_IF_ENABLED(SOURCE_MODULE, '[-] Got exception during compaction: {0}'.format(ex))
+
+    def stats(self):
+        with self._locked():
+            self._refresh()
+            sizes = [os.path.getsize(self._segment_path(base)) for base in self._segments]
+            consumed = sum(
+                size for base, size in zip(self._segments, sizes) if base < self._cursor[1]) + self._cursor[2]
+            return dict(
+                items=self._tail[0] - self._cursor[0],
+                stored_bytes=sum(sizes) - consumed,
+                disk_bytes=sum(sizes),
+                segments=len(self._segments),
+                written=self._tail[0],
+                consumed=self._cursor[0])
+
+    def close(self):
+        self._stop.set()
+        if self._compactor is not None:
+            self._compactor.join()
+        with self._lock:
+            for base in list(self._maps):
+                self._unmap(base)
+            self._lock_file.close()
+
+
+def make_cwe_cache():
+    """
+    Open the CWE staging cache with the backend chosen by SETTINGS["cwe"]["cache_backend"]:
+    'sqlite' for DequeDiskCache or 'log' for SegmentLogCache.
+    """
+    settings = SETTINGS.get("cwe", {})
+    if not os.path.exists(CWE_CACHE_DIRECTORY):
+        LOGINFO_IF_ENABLED(SOURCE_MODULE, '[+] Create folder for diskcache')
+        os.makedirs(CWE_CACHE_DIRECTORY)
+    if settings.get("cache_backend", "sqlite") == 'log':
+        return SegmentLogCache(
+            directory=CWE_LOG_DIRECTORY,
+            codec=settings.get("cache_codec", "zlib"))
+    return DequeDiskCache(
+        directory=CWE_CACHE_DIRECTORY,
+        codec=settings.get("cache_codec", "zlib"),
+        max_items=settings.get("cache_max_items"),
+        max_bytes=settings.get("cache_max_bytes"),
+        eviction_policy=settings.get("cache_eviction_policy", "drop-oldest"),
+        max_archive_bytes=settings.get("cache_max_archive_bytes"))
@@ -2,64 +2,35 @@ import os
 import sys
 import abc
 import time
-import json
-import zlib
 import enum
+import redis
+import asyncio
+import resource
+import threading
+from functools import partial
 
 baseDir = os.path.dirname(os.path.abspath(os.path.dirname(__file__)))
 sys.path.append(baseDir)
 
-from flask import Flask
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from datetime import datetime
+from collections import deque
 from xml.sax import make_parser
-from xml.sax.handler import ContentHandler
 from logger import LOGERR_IF_ENABLED, LOGINFO_IF_ENABLED
-from utils import get_file, get_module_name, check_internet_connection
+from utils import get_file, get_module_name, StreamDecompressor
+from utils import serialize_as_json_for_cache
 from settings import SETTINGS
+from caches import VulnerabilityCache, make_key
+from queues import get_stats
 
-from diskcache import Deque
+from dsklog import make_cwe_cache
+from dskcodecs import is_portable
+from cweparser import CWEHandler, make_cwe_cache_item
 
 SOURCE_MODULE = '[{0}] :: '.format(get_module_name(__file__))
 PLUGIN_NAME = get_module_name(__file__)
 
 
-class CWEHandler(ContentHandler):
-    def __init__(self):
-        self.cwe = []
-        self.description_summary_tag = False
-        self.weakness_tag = False
-
-    def startElement(self, name, attrs):
-        if name == 'Weakness':
-            self.weakness_tag = True
-            self.statement = ""
-            self.weaknesses = attrs.get('Weakness_Abstraction')
-            self.name = attrs.get('Name')
-            self.idname = attrs.get('ID')
-            self.status = attrs.get('Status')
-            self.cwe.append({
-                'name': self.name,
-                'id': self.idname,
-                'status': self.status,
-                'weaknesses': self.weaknesses})
-        elif name == 'Description_Summary' and self.weakness_tag:
-            self.description_summary_tag = True
-            self.description_summary = ""
-
-    def characters(self, ch):
-        if self.description_summary_tag:
-            self.description_summary += ch.replace("       ", "")
-
-    def endElement(self, name):
-        if name == 'Description_Summary' and self.weakness_tag:
-            self.description_summary_tag = False
-            self.description_summary = self.description_summary + self.description_summary
-            self.cwe[-1]['description_summary'] = self.description_summary.replace("\n", "")
-        elif name == 'Weakness':
-            self.weakness_tag = False
-
-
-
 class State(enum.Enum):
     start = 1
     pending = 2
@@ -71,29 +42,141 @@ class State(enum.Enum):
 
 
 
+class CWEChunkParser(object):
+    """
+    Incremental CWE parser fed with raw download chunks.
+    feed() returns the weaknesses completed by the chunk.
+    """
+
+    def __init__(self, content_type=''):
+        self.decompressor = StreamDecompressor(content_type)
+        self.parsed = []
+        self.parser = make_parser()
+        self.parser.setContentHandler(CWEHandler(on_weakness=self.parsed.append))
+
+    def _take(self):
+        parsed = list(self.parsed)
+        del self.parsed[:]
+        return parsed
+
+    def feed(self, chunk):
+        self.parser.feed(self.decompressor.decompress(chunk))
+        return self._take()
+
+    def close(self):
+        self.parser.close()
+        return self._take()
+
+
+class ObserverDispatcher(object):
+    """
+    Deliver states to one observer from its own daemon thread.
+    notify() only appends to a bounded queue and never waits for the observer;
+    states that pile up while the observer is busy are handed over together
+    through observer.update_many, and the oldest are dropped past `max_pending`.
+    """
+
+    def __init__(self, observer, max_pending=None):
+        self.observer = observer
+        self._pending = deque(maxlen=max_pending or SETTINGS.get("cwe", {}).get("observer_max_pending", 1000))
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name='ObserverDispatcher-{0}'.format(type(observer).__name__), daemon=True)
+        self._thread.start()
+
+    def notify(self, state):
+        with self._condition:
+            self._pending.append(state)
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                states = list(self._pending)
+                self._pending.clear()
+            try:
+                self.observer.update_many(states)
+            except Exception as ex:
+                LOGERR_IF_ENABLED(SOURCE_MODULE, '[-] Observer {0} failed: {1}'.format(type(self.observer).__name__, ex))
+
+    def close(self, timeout=None):
+        """
+        Deliver what is pending and stop the thread. Return True if it stopped in time.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+
 class CWEUpdater:
     """
     CWE Updater State Machine.
     Know its observers to Notify it.
     Any number of Observer objects may observe a subject.
     Send a notification to its observers when its state changes.
+
+    An update is an asyncio pipeline of download, parse, caching_local and
+    caching_global stages connected by bounded queues, so downloading chunk N+1
+    overlaps parsing chunk N and caching the batch before it. Blocking work runs
+    in `executor` (the loop default one if None). Every stage switches the state
+    when it starts working.
+
+    With `dispatch` 'async' (SETTINGS["cwe"]["observer_dispatch"]) observers are
+    notified through an ObserverDispatcher each, so a slow observer never
+    blocks the state machine; 'sync' calls update() in place.
     """
 
-    def __init__(self):
+    def __init__(self, source=None, cache=None, global_cache=None, queue_size=None,
+                 chunk_size=None, batch_size=None, executor=None, dispatch=None):
+        settings = SETTINGS.get("cwe", {})
         self._observers = set()
+        self._dispatchers = {}
+        self.dispatch = dispatch or settings.get("observer_dispatch", "async")
         self._subject_state = None
-
-    def attach(self, observer):
+        self.source = source or settings.get("source")
+        self.cache = cache
+        self.global_cache = global_cache
+        self.queue_size = queue_size or settings.get("pipeline_queue_size", 4)
+        self.chunk_size = chunk_size or settings.get("parser_chunk_size", 64 * 1024)
+        self.batch_size = batch_size or settings.get("cache_batch_size", 500)
+        self.executor = executor
+        self.counters = {}
+
+    def attach(self, observer, dispatch=None):
         observer._subject = self
         self._observers.add(observer)
+        dispatch = dispatch or getattr(observer, 'dispatch', None) or self.dispatch
+        if dispatch == 'async' and observer not in self._dispatchers:
+            self._dispatchers[observer] = ObserverDispatcher(observer)
 
     def detach(self, observer):
         observer._subject = None
         self._observers.discard(observer)
+        dispatcher = self._dispatchers.pop(observer, None)
+        if dispatcher is not None:
+            dispatcher.close()
 
     def _notify(self):
-        for observer in self._observers:
-            observer.update(self._subject_state)
+        for observer in list(self._observers):
+            dispatcher = self._dispatchers.get(observer)
+            if dispatcher is not None:
+                dispatcher.notify(self._subject_state)
+            else:
+                observer.update(self._subject_state)
+
+    def close(self, timeout=None):
+        """
+        Deliver pending notifications and stop the dispatcher threads.
+        """
+        for observer in list(self._dispatchers):
+            self._dispatchers.pop(observer).close(timeout)
 
     @property
     def subject_state(self):
@@ -104,14 +187,137 @@ class CWEUpdater:
         self._subject_state = arg
         self._notify()
 
-    def start(self):
+    def _enter(self, state, entered):
+        if state not in entered:
+            entered.add(state)
+            self.subject_state = state.value
+
+    def _count(self, name, value):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    async def _in_executor(self, state, function, *args):
+        """
+        Run blocking work of a stage and add its time to the `<state>_seconds` counter.
+        """
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, partial(function, *args))
+        finally:
+            self._count('{0}_seconds'.format(state.name), time.perf_counter() - started)
+
+    async def _open_source(self):
+        response = await self._in_executor(State.pending, partial(get_file, getfile=self.source, raw=True))
+        if isinstance(response, tuple):
+            raise IOError('Can not download CWE source: {0}'.format(response[1]))
+        return response
+
+    async def _download(self, response, chunks, entered):
+        try:
+            self._enter(State.downloading, entered)
+            while True:
+                chunk = await self._in_executor(State.downloading, response.read, self.chunk_size)
+                if not chunk:
+                    break
+                self._count('downloaded_bytes', len(chunk))
+                await chunks.put(chunk)
+        finally:
+            response.close()
+        await chunks.put(None)
+
+    async def _parse(self, content_type, chunks, batches, entered):
+        parser = CWEChunkParser(content_type)
+        batch = []
+        while True:
+            chunk = await chunks.get()
+            if chunk is None:
+                break
+            self._enter(State.parsing, entered)
+            batch.extend(await self._in_executor(State.parsing, parser.feed, chunk))
+            if len(batch) >= self.batch_size:
+                await batches.put(batch)
+                batch = []
+        batch.extend(await self._in_executor(State.parsing, parser.close))
+        if batch:
+            await batches.put(batch)
+        await batches.put(None)
+
+    async def _cache_local(self, batches, cached, entered):
+        while True:
+            batch = await batches.get()
+            if batch is None:
+                break
+            self._enter(State.caching_local, entered)
+            items = [make_cwe_cache_item(cwe) for cwe in batch]
+            self._count('records', len(items))
+            written_bytes = self.cache.written_bytes
+            blobs = await self._in_executor(State.caching_local, self.cache.encode_many, items)
+            await self._in_executor(State.caching_local, self.cache.extend_encoded, blobs, items)
+            self._count('compressed_bytes', self.cache.written_bytes - written_bytes)
+            await cached.put((items, blobs))
+        await cached.put(None)
+
+    async def _cache_global(self, cached, entered):
+        """
+        Write cache items to the global cache under cwe::<id>.
+        Encoded values that do not need the local zlib dictionary
+        are passed through as they are, without serializing the items again;
+        they are stored under dsk::cwe::<id> (see caches.make_encoded_key) and
+        read back through VulnerabilityCache.get, cwe::<id> only ever holds JSON.
+        """
+        while True:
+            batch = await cached.get()
+            if batch is None:
+                break
+            self._enter(State.caching_global, entered)
+            encoded, items = {}, {}
+            for item, blob in zip(*batch):
+                key = make_key('cwe', item['data']['id'])
+                if is_portable(blob):
+                    encoded[key] = blob
+                else:
+                    items[key] = item
+            if encoded:
+                await self._in_executor(State.caching_global, self.global_cache.set_many_encoded, encoded)
+                self._count('passthrough_records', len(encoded))
+            if items:
+                await self._in_executor(State.caching_global, self.global_cache.set_many, items)
+
+    async def run(self):
+        """
+        Run one update through the pipeline. Return the counters of the run.
+        """
+        if self.cache is None:
+            self.cache = make_cwe_cache()
+        if self.global_cache is None:
+            self.global_cache = VulnerabilityCache()
+        self.counters = {}
+        entered = set()
         self.subject_state = State.start.value
-        time.sleep(1)
-        self.subject_state = State.downloading.value
-        time.sleep(1)
-        self.subject_state = State.parsing.value
-        time.sleep(1)
-        self.subject_state = State.idle.value
+        try:
+            self.subject_state = State.pending.value
+            response = await self._open_source()
+            content_type = response.info().get('Content-Type') or ''
+            chunks = asyncio.Queue(maxsize=self.queue_size)
+            batches = asyncio.Queue(maxsize=self.queue_size)
+            cached = asyncio.Queue(maxsize=self.queue_size)
+            tasks = [asyncio.ensure_future(stage) for stage in (
+                self._download(response, chunks, entered),
+                self._parse(content_type, chunks, batches, entered),
+                self._cache_local(batches, cached, entered),
+                self._cache_global(cached, entered))]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+        finally:
+            self.subject_state = State.idle.value
+        return self.counters
+
+    def start(self):
+        return asyncio.run(self.run())
 
 
 class Observer(metaclass=abc.ABCMeta):
@@ -128,6 +334,13 @@ class Observer(metaclass=abc.ABCMeta):
     def update(self, arg):
         pass
 
+    def update_many(self, args):
+        """
+        Take the states queued while the observer was busy.
+        Coalesce them into the latest one by default.
+        """
+        self.update(args[-1])
+
 
 class CWEUpdaterLogObserver(Observer):
     """
@@ -140,17 +353,218 @@ class CWEUpdaterLogObserver(Observer):
         self._observer_state = state
         LOGINFO_IF_ENABLED(SOURCE_MODULE, '[s] Set state as: {}'.format(state))
 
+    def update_many(self, states):
+        for state in states:
+            self.update(state)
+
 
 class CWEUpdaterRedisObserver(Observer):
     """
     Implement the Observer updating interface to keep its state consistent with the subject's.
     Store state that should stay consistent with the subject's.
     Notify User by REDIS.
+    Every state is published to the stats channel and the latest one is kept
+    in the stats collection hash; a batch of states goes through one pipeline.
     """
 
+    def __init__(self, connection=None):
+        super(CWEUpdaterRedisObserver, self).__init__()
+        self.connection = connection
+
     def update(self, state):
+        self.update_many([state])
+
+    def update_many(self, states):
+        self._observer_state = states[-1]
+        connection = self.connection or get_stats()
+        messages = [serialize_as_json_for_cache(dict(
+            plugin=PLUGIN_NAME,
+            state=State(state).name,
+            time=datetime.utcnow().isoformat())) for state in states]
+        try:
+            pipe = connection.pipeline(transaction=False)
+            for message in messages:
+                pipe.publish(SETTINGS["queue"]["stats_channel"], message)
+            pipe.hset(SETTINGS["queue"]["stats_collection"], PLUGIN_NAME, messages[-1])
+            pipe.execute()
+        except redis.RedisError as ex:
+            LOGERR_IF_ENABLED(SOURCE_MODULE, '[-] Got exception during publishing state: {0}'.format(ex))
+
+
+def peak_rss_bytes():
+    """
+    Peak resident set size of this process (ru_maxrss is in bytes on macOS, in KiB elsewhere).
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class CWEUpdaterMetricsExporter(object):
+    """
+    Write metrics records to the stats Redis DB in one pipeline per batch:
+    the latest record of every state goes to the metrics::<plugin> hash and
+    every record is published to the stats channel as a stats message.
+    Used through an ObserverDispatcher, so the updater never waits for Redis.
+    """
+
+    def __init__(self, connection=None):
+        self.connection = connection
+
+    def update_many(self, records):
+        connection = self.connection or get_stats()
+        try:
+            pipe = connection.pipeline(transaction=False)
+            for record in records:
+                message = serialize_as_json_for_cache(record)
+                pipe.hset(make_key('metrics', record['plugin']), record['state'], message)
+                pipe.publish(SETTINGS["queue"]["stats_channel"], serialize_as_json_for_cache(dict(
+                    message=SETTINGS["queue"]["stats_message"],
+                    metrics=record)))
+            pipe.execute()
+        except redis.RedisError as ex:
+            LOGERR_IF_ENABLED(SOURCE_MODULE, '[-] Got exception during exporting metrics: {0}'.format(ex))
+
+
+class CWEUpdaterMetricsObserver(Observer):
+    """
+    Implement the Observer updating interface to keep its state consistent with the subject's.
+    Time every state and take what flowed through it from the subject counters:
+    duration, busy time of its stage, records and records/sec, downloaded and
+    compressed bytes, and the peak RSS at the end of the state.
+    Stages overlap, so the 'cycle' record at idle also keeps the busy time
+    of every stage over the whole run.
+    Reads the counters at the transition, so it is always notified in place;
+    export to Redis goes through its own dispatcher.
+    """
+
+    dispatch = 'sync'
+
+    def __init__(self, exporter=None):
+        super(CWEUpdaterMetricsObserver, self).__init__()
+        self.metrics = {}
+        self.cycles = 0
+        self._entered_at = None
+        self._cycle_started = None
+        self._counters = {}
+        self._exporter = ObserverDispatcher(exporter or CWEUpdaterMetricsExporter())
+
+    def _record(self, state, started, counters, now):
+        duration = now - started
+        delta = dict(
+            (name, counters.get(name, 0) - self._counters.get(name, 0))
+            for name in ('records', 'downloaded_bytes', 'compressed_bytes', '{0}_seconds'.format(state.name)))
+        return dict(
+            plugin=PLUGIN_NAME,
+            state=state.name,
+            time=datetime.utcnow().isoformat(),
+            duration_sec=duration,
+            busy_sec=delta['{0}_seconds'.format(state.name)],
+            records=delta['records'],
+            records_per_sec=delta['records'] / duration if duration > 0 else 0.0,
+            downloaded_bytes=delta['downloaded_bytes'],
+            compressed_bytes=delta['compressed_bytes'],
+            peak_rss_bytes=peak_rss_bytes())
+
+    def _cycle_record(self, counters, now):
+        duration = now - self._cycle_started
+        records = counters.get('records', 0)
+        return dict(
+            plugin=PLUGIN_NAME,
+            state='cycle',
+            time=datetime.utcnow().isoformat(),
+            duration_sec=duration,
+            busy_sec=sum(counters.get('{0}_seconds'.format(state.name), 0) for state in State),
+            stage_busy_sec=dict(
+                (state.name, counters['{0}_seconds'.format(state.name)])
+                for state in State if '{0}_seconds'.format(state.name) in counters),
+            records=records,
+            records_per_sec=records / duration if duration > 0 else 0.0,
+            downloaded_bytes=counters.get('downloaded_bytes', 0),
+            compressed_bytes=counters.get('compressed_bytes', 0),
+            peak_rss_bytes=peak_rss_bytes())
+
+    def update(self, state):
+        now = time.perf_counter()
+        counters = dict(getattr(self._subject, 'counters', None) or {})
+        if state == State.start.value:
+            self._counters = {}
+            self._cycle_started = now
+        if self._observer_state is not None and self._entered_at is not None:
+            record = self._record(State(self._observer_state), self._entered_at, counters, now)
+            self.metrics[record['state']] = record
+            self._exporter.notify(record)
+        if state == State.idle.value and self._cycle_started is not None:
+            self.cycles += 1
+            record = self._cycle_record(counters, now)
+            self.metrics[record['state']] = record
+            self._exporter.notify(record)
+            self._cycle_started = None
         self._observer_state = state
-        print('*** Set Redis state: {}'.format(state))
+        self._entered_at = now
+        self._counters = counters
+
+    def close(self, timeout=None):
+        return self._exporter.close(timeout)
+
+    def to_prometheus(self):
+        """
+        Metrics of the latest run of every state in the Prometheus text format.
+        """
+        lines = []
+        gauges = (
+            ('duration_sec', 'updater_state_duration_seconds', 'Wall time spent in the state'),
+            ('busy_sec', 'updater_state_busy_seconds', 'Time the stage of the state spent working'),
+            ('records', 'updater_state_records', 'Records that flowed through the state'),
+            ('records_per_sec', 'updater_state_records_per_second', 'Records per second in the state'),
+            ('downloaded_bytes', 'updater_state_downloaded_bytes', 'Bytes downloaded in the state'),
+            ('compressed_bytes', 'updater_state_compressed_bytes', 'Compressed bytes written in the state'),
+        )
+        for field, name, help_text in gauges:
+            lines.append('# HELP {0} {1}'.format(name, help_text))
+            lines.append('# TYPE {0} gauge'.format(name))
+            for state, record in sorted(self.metrics.items()):
+                lines.append('{0}{{plugin="{1}",state="{2}"}} {3}'.format(name, PLUGIN_NAME, state, record[field]))
+        cycle = self.metrics.get('cycle', {})
+        lines.append('# HELP updater_stage_busy_seconds Time every stage spent working in the latest cycle')
+        lines.append('# TYPE updater_stage_busy_seconds gauge')
+        for stage, seconds in sorted(cycle.get('stage_busy_sec', {}).items()):
+            lines.append('updater_stage_busy_seconds{{plugin="{0}",stage="{1}"}} {2}'.format(PLUGIN_NAME, stage, seconds))
+        lines.append('# HELP updater_peak_rss_bytes Peak resident set size of the updater process')
+        lines.append('# TYPE updater_peak_rss_bytes gauge')
+        lines.append('updater_peak_rss_bytes{{plugin="{0}"}} {1}'.format(PLUGIN_NAME, peak_rss_bytes()))
+        lines.append('# HELP updater_cycles_total Completed update cycles')
+        lines.append('# TYPE updater_cycles_total counter')
+        lines.append('updater_cycles_total{{plugin="{0}"}} {1}'.format(PLUGIN_NAME, self.cycles))
+        return '\n'.join(lines) + '\n'
+
+
+def make_metrics_server(metrics_observer, host=None, port=None):
+    """
+    HTTP server exposing the metrics observer at /metrics for Prometheus to scrape.
+    Host and port default to SETTINGS["cwe"]["metrics_host"] (loopback) and ["metrics_port"].
+    Call serve_forever() on it, e.g. in a daemon thread.
+    """
+    settings = SETTINGS.get("cwe", {})
+    host = settings.get("metrics_host", "127.0.0.1") if host is None else host
+    port = settings.get("metrics_port", 9108) if port is None else port
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics_observer.to_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), MetricsHandler)
 
 
 def main():
@@ -162,8 +576,19 @@ def main():
     cwe_updater_redis_observer = CWEUpdaterRedisObserver()
     cwe_updater_machine.attach(cwe_updater_redis_observer)
 
+    cwe_updater_metrics_observer = CWEUpdaterMetricsObserver()
+    cwe_updater_machine.attach(cwe_updater_metrics_observer)
+    if SETTINGS.get("cwe", {}).get("metrics_port"):
+        threading.Thread(
+            target=make_metrics_server(cwe_updater_metrics_observer).serve_forever,
+            name='CWEUpdaterMetrics', daemon=True).start()
+
     cwe_updater_machine.subject_state = State.idle.value
-    cwe_updater_machine.start()
+    try:
+        cwe_updater_machine.start()
+    finally:
+        cwe_updater_machine.close()
+        cwe_updater_metrics_observer.close()
 
 
 if __name__ == '__main__':
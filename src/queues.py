@@ -0,0 +1,82 @@
+import os
+import sys
+import redis
+
+baseDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(baseDir, 'plugins'))
+
+from settings import SETTINGS
+from logger import LOGERR_IF_ENABLED
+from utils import get_module_name, serialize_as_json_for_cache
+from dskcodecs import frame_encoded
+
+SOURCE_MODULE = '[{0}] :: '.format(get_module_name(__file__))
+
+_queue = None
+_raw_queue = None
+
+
+def get_queue(raw=False):
+    """
+    Get shared connection to the queue Redis DB.
+    With `raw` the connection returns bytes, as needed for pre-encoded elements.
+    """
+    global _queue, _raw_queue
+    if raw:
+        if _raw_queue is None:
+            _raw_queue = redis.StrictRedis(
+                host=SETTINGS["queue"]["host"],
+                port=SETTINGS["queue"]["port"],
+                db=SETTINGS["queue"]["db"],
+                decode_responses=False)
+        return _raw_queue
+    if _queue is None:
+        _queue = redis.StrictRedis(
+            host=SETTINGS["queue"]["host"],
+            port=SETTINGS["queue"]["port"],
+            db=SETTINGS["queue"]["db"],
+            encoding=SETTINGS["queue"]["charset"],
+            decode_responses=SETTINGS["queue"]["decode_responses"])
+    return _queue
+
+
+def push_to_queue(queue_name, elements, queue=None, content_encoding=None):
+    """
+    Push elements to the tail of a Redis list in one pipeline.
+    With `content_encoding` (dskcodecs.CONTENT_ENCODING_DSK) elements are
+    pre-encoded DequeDiskCache blobs pushed as they are, framed with the marker.
+    Return the number of pushed elements.
+    """
+    if not elements:
+        return 0
+    queue = queue or get_queue(raw=content_encoding is not None)
+    try:
+        pipe = queue.pipeline(transaction=False)
+        for element in elements:
+            if content_encoding is not None:
+                pipe.rpush(queue_name, frame_encoded(element, content_encoding))
+            else:
+                pipe.rpush(queue_name, serialize_as_json_for_cache(element))
+        pipe.execute()
+        return len(elements)
+    except redis.RedisError as ex:
+        LOGERR_IF_ENABLED(SOURCE_MODULE, '[-] Got exception during pushing to {0}: {1}'.format(queue_name, ex))
+        return 0
+
+
+_stats = None
+
+
+def get_stats():
+    """
+    Get shared connection to the stats Redis DB.
+    """
+    global _stats
+    if _stats is None:
+        _stats = redis.StrictRedis(
+            host=SETTINGS["stats"]["host"],
+            port=SETTINGS["stats"]["port"],
+            db=SETTINGS["stats"]["db"],
+            encoding=SETTINGS["stats"]["charset"],
+            decode_responses=SETTINGS["stats"]["decode_responses"])
+    return _stats
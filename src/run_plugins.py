@@ -0,0 +1,256 @@
+import os
+import re
+import sys
+import time
+import heapq
+import signal
+import threading
+import importlib
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+
+baseDir = os.path.dirname(os.path.abspath(__file__))
+PLUGINS_DIRECTORY = os.path.join(baseDir, 'plugins')
+sys.path.append(baseDir)
+sys.path.append(PLUGINS_DIRECTORY)
+
+from settings import SETTINGS
+from logger import LOGERR_IF_ENABLED, LOGINFO_IF_ENABLED, LOGWARN_IF_ENABLED
+from utils import get_module_name
+from downloads import connectivity
+from databases import init_databases
+
+SOURCE_MODULE = '[{0}] :: '.format(get_module_name(__file__))
+
+PLUGIN_MODULE_PATTERN = re.compile(r'^(?:\w+_)?plg_(\w+?)(?:_updater)?\.py$')
+PLUGIN_JOB_PREFIX = 'job_for_'
+
+
+def run_plugin_job(module_name, job_name):
+    """
+    Import the plugin module and run its job.
+    Takes names only, so the same call works in a worker process.
+    """
+    return getattr(importlib.import_module(module_name), job_name)()
+
+
+def parse_runtime(runtime):
+    """
+    'HH:MM' -> (hour, minute), or None for an empty runtime.
+    """
+    if not runtime:
+        return None
+    hour, minute = runtime.split(':')
+    return int(hour), int(minute)
+
+
+class Plugin(object):
+    """
+    One discovered plugin job and its schedule.
+    Schedule keys are read from SETTINGS[source] with the global values as defaults:
+    start_delay and updater_delay in seconds, updater_runtime as a daily 'HH:MM',
+    max_concurrency as the number of runs allowed at the same time.
+    """
+
+    def __init__(self, module_name, job_name, source):
+        settings = SETTINGS.get(source, {})
+        plugins = SETTINGS.get("plugins", {})
+        self.module_name = module_name
+        self.job_name = job_name
+        self.source = source
+        self.name = '{0}.{1}'.format(module_name, job_name)
+        self.start_delay = settings.get("start_delay", SETTINGS.get("start_delay", 0))
+        self.updater_delay = settings.get("updater_delay", SETTINGS.get("updater_delay", 1200))
+        self.updater_runtime = parse_runtime(settings.get("updater_runtime", SETTINGS.get("updater_runtime")))
+        self.max_concurrency = settings.get("max_concurrency", plugins.get("max_concurrency", 1))
+        self.running = set()
+        self.started_at = {}
+        self.last_start = 0
+        self.runs = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def next_run(self, now):
+        """
+        Monotonic time of the next run: after updater_delay, or earlier at the daily runtime.
+        """
+        next_run = now + self.updater_delay
+        if self.updater_runtime is not None:
+            wall = datetime.now()
+            runtime = wall.replace(hour=self.updater_runtime[0], minute=self.updater_runtime[1], second=0, microsecond=0)
+            if runtime <= wall:
+                runtime += timedelta(days=1)
+            next_run = min(next_run, now + (runtime - wall).total_seconds())
+        return next_run
+
+
+def discover_plugins(directory=PLUGINS_DIRECTORY):
+    """
+    Import every plg_* module (also with a prefix, like back_1_plg_cwe_updater)
+    and collect its job_for_* functions. Modules that fail to import are logged and skipped.
+    """
+    plugins = []
+    for filename in sorted(os.listdir(directory)):
+        match = PLUGIN_MODULE_PATTERN.match(filename)
+        if match is None:
+            continue
+        module_name = filename[:-3]
+        try:
+            module = importlib.import_module(module_name)
+        except Exception as ex:
+            LOGERR_IF_ENABLED(SOURCE_MODULE, '[-] Can not load plugin {0}: {1}'.format(module_name, ex))
+            continue
+        jobs = [name for name in dir(module) if name.startswith(PLUGIN_JOB_PREFIX) and callable(getattr(module, name))]
+        if not jobs:
+            LOGINFO_IF_ENABLED(SOURCE_MODULE, '[i] Plugin {0} has no {1}* jobs'.format(module_name, PLUGIN_JOB_PREFIX))
+        for job_name in jobs:
+            plugins.append(Plugin(module_name, job_name, match.group(1)))
+    return plugins
+
+
+class PluginRunner(object):
+    """
+    Run plugin jobs on one bounded thread or process pool.
+    A scheduler thread starts every due job; a job whose previous runs
+    still hold all of its max_concurrency slots is skipped until its next turn.
+    When several jobs are due, the one that started least recently goes first,
+    so the pool is shared fairly. stop() lets running jobs finish
+    for up to shutdown_timeout_in_sec.
+    """
+
+    def __init__(self, plugins=None, max_workers=None, executor=None, shutdown_timeout=None):
+        settings = SETTINGS.get("plugins", {})
+        self.plugins = plugins if plugins is not None else discover_plugins()
+        self.max_workers = max_workers or settings.get("max_workers", 4)
+        self.executor_type = executor or settings.get("executor", "thread")
+        self.shutdown_timeout = shutdown_timeout or settings.get("shutdown_timeout_in_sec", 60)
+        self.executor = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _make_executor(self):
+        if self.executor_type == 'process':
+            # Worker processes get their own connection pool.
+            return ProcessPoolExecutor(max_workers=self.max_workers, initializer=init_databases)
+        return ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='PluginRunner')
+
+    def submit(self, plugin):
+        """
+        Start one run of `plugin` if it has a free slot. Return the future or None if skipped.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if len(plugin.running) >= plugin.max_concurrency:
+                plugin.skipped += 1
+                oldest = min(plugin.started_at[future] for future in plugin.running)
+                LOGWARN_IF_ENABLED(SOURCE_MODULE, '[!] Skip {0}: previous run is still going for {1:.0f} sec'.format(
+                    plugin.name, now - oldest))
+                return None
+            future = self.executor.submit(run_plugin_job, plugin.module_name, plugin.job_name)
+            plugin.running.add(future)
+            plugin.started_at[future] = now
+            plugin.last_start = now
+            plugin.runs += 1
+        LOGINFO_IF_ENABLED(SOURCE_MODULE, '[+] Started {0}'.format(plugin.name))
+        future.add_done_callback(lambda done: self._on_done(plugin, done))
+        return future
+
+    def _on_done(self, plugin, future):
+        with self._lock:
+            plugin.running.discard(future)
+            started = plugin.started_at.pop(future, time.monotonic())
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            plugin.failed += 1
+            LOGERR_IF_ENABLED(SOURCE_MODULE, '[-] {0} failed: {1}'.format(plugin.name, error))
+        else:
+            LOGINFO_IF_ENABLED(SOURCE_MODULE, '[+] {0} completed in {1:.1f} sec'.format(
+                plugin.name, time.monotonic() - started))
+
+    def _run(self):
+        now = time.monotonic()
+        schedule = [(now + plugin.start_delay, index) for index, plugin in enumerate(self.plugins)]
+        heapq.heapify(schedule)
+        while schedule and not self._stop.is_set():
+            due_at = schedule[0][0]
+            if self._stop.wait(max(0, due_at - time.monotonic())):
+                break
+            now = time.monotonic()
+            due = []
+            while schedule and schedule[0][0] <= now:
+                due.append(heapq.heappop(schedule)[1])
+            for index in sorted(due, key=lambda index: self.plugins[index].last_start):
+                plugin = self.plugins[index]
+                self.submit(plugin)
+                heapq.heappush(schedule, (plugin.next_run(time.monotonic()), index))
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self.executor = self._make_executor()
+        self._thread = threading.Thread(target=self._run, name='PluginScheduler', daemon=True)
+        self._thread.start()
+        LOGINFO_IF_ENABLED(SOURCE_MODULE, '[+] Scheduled {0} plugins on {1} {2} workers'.format(
+            len(self.plugins), self.max_workers, self.executor_type))
+
+    def running(self):
+        with self._lock:
+            return [future for plugin in self.plugins for future in plugin.running]
+
+    def stop(self, timeout=None):
+        """
+        Stop scheduling, wait for running jobs up to `timeout` seconds
+        and drop queued ones. Return the number of jobs still running.
+        """
+        timeout = self.shutdown_timeout if timeout is None else timeout
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.executor is None:
+            return 0
+        _, not_done = wait(self.running(), timeout=timeout)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        if not_done:
+            LOGERR_IF_ENABLED(SOURCE_MODULE, '[-] {0} jobs did not finish in {1} sec'.format(len(not_done), timeout))
+        return len(not_done)
+
+    def wait(self):
+        while not self._stop.wait(1):
+            pass
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main(args):
+    runner = PluginRunner()
+    if not runner.plugins:
+        LOGERR_IF_ENABLED(SOURCE_MODULE, '[-] No plugins found in {0}'.format(PLUGINS_DIRECTORY))
+        return 1
+
+    def shutdown(signum, frame):
+        LOGINFO_IF_ENABLED(SOURCE_MODULE, '[+] Got signal {0}, shutting down'.format(signum))
+        runner._stop.set()
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+    init_databases()
+    connectivity.start()
+    runner.start()
+    runner.wait()
+    try:
+        return 1 if runner.stop() else 0
+    finally:
+        connectivity.stop()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -6,6 +6,10 @@ SETTINGS = {
         "host": "localhost",
         "port": "5432",
         "reconnect_count": 1000,
+        "reconnect_backoff_in_sec": 1,
+        "reconnect_backoff_max_in_sec": 30,
+        "max_connections": 8,
+        "stale_timeout_in_sec": 300,
         "updater_offset": 1000
     },
     "queue": {
@@ -51,7 +55,10 @@ SETTINGS = {
         "db": 3,
         "separator": "::",
         "index": "index",
+        "encoded_namespace": "dsk",
         "key_expire_time_in_sec": 60*60*48,
+        "local_size": 10000,
+        "local_ttl_in_sec": 60,
         "charset": "utf-8",
         "decode_responses": True,
     },
@@ -84,11 +91,29 @@ SETTINGS = {
         "drop_cve_table": False,
         "start_year": 2002,
         "download_retry_count": 5,
-        "download_retry_timeout_in_sec": 60
+        "download_retry_timeout_in_sec": 60,
+        "source": "https://nvd.nist.gov/feeds/json/cve/1.0/nvdcve-1.0-{year}.json.gz"
     },
     "cwe": {
         "drop_cwe_table": False,
-        "source": "http://cwe.mitre.org/data/xml/cwec_v2.8.xml.zip"
+        "source": "http://cwe.mitre.org/data/xml/cwec_v2.8.xml.zip",
+        "parser_chunk_size": 64 * 1024,
+        "cache_batch_size": 500,
+        "cache_codec": "zlib",
+        "cache_max_items": None,
+        "cache_max_bytes": 256 * 1024 * 1024,
+        "cache_eviction_policy": "drop-oldest",
+        "cache_max_archive_bytes": 256 * 1024 * 1024,
+        "cache_backend": "sqlite",
+        "log_segment_size": 64 * 1024 * 1024,
+        "log_compact_interval_in_sec": 60,
+        "group_lease_timeout_in_sec": 300,
+        "group_max_deliveries": None,
+        "pipeline_queue_size": 4,
+        "observer_dispatch": "async",
+        "observer_max_pending": 1000,
+        "metrics_host": "127.0.0.1",
+        "metrics_port": 9108
     },
     "capec": {
         "drop_capec_table": False,
@@ -110,6 +135,20 @@ SETTINGS = {
     "hacker_news": {
         "drop_hacker_news_table": False
     },
+    "download": {
+        "max_workers": 8,
+        "per_host_limit": 4,
+        "timeout_in_sec": 60,
+        "backoff_base_in_sec": 1,
+        "connectivity_ttl_in_sec": 60,
+        "connectivity_timeout_in_sec": 3
+    },
+    "plugins": {
+        "executor": "thread",
+        "max_workers": 4,
+        "max_concurrency": 1,
+        "shutdown_timeout_in_sec": 60
+    },
     "enable_extra_logging": True,
     "enable_results_logging": False,
     "enable_exception_logging": True,
@@ -1,14 +1,21 @@
 import os
 import re
 import json
+import hashlib
 import ast
 import bz2
 import gzip
 import enum
 import requests
 import platform
+import tempfile
 import urllib.request as req
 import zipfile
+import zlib
+import struct
+from itertools import islice
+from functools import partial
+from collections.abc import Mapping
 from dateutil.parser import parse as parse_datetime
 from datetime import datetime
 from math import floor
@@ -75,6 +82,9 @@ def get_module_name(__file__):
 
 SOURCE_MODULE = '[{0}] :: '.format(get_module_name(__file__))
 
+NOT_MODIFIED = 'not modified'
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
 
 def now():
     """
@@ -174,6 +184,121 @@ def reformat_vulnerability_for_output(item):
     return None
 
 
+OUTPUT_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+ISO_TIME_PATTERN = re.compile(
+    r"^(\d{4})-(\d{2})-(\d{2})(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.\d{1,6})?)?(?:[+-]\d{2}:?\d{2})?)?$")
+# JSON tokens that ast.literal_eval does not accept the same way
+NON_PYTHON_JSON_PATTERN = re.compile(r"\\|\b(?:true|false|null|NaN|Infinity)\b")
+
+
+def fast_unify_time(dt):
+    """
+    unify_time without a dateutil round-trip for datetimes and plain ISO strings.
+    """
+    if isinstance(dt, str):
+        if 'Z' in dt:
+            dt = dt.replace('Z', '')
+        match = ISO_TIME_PATTERN.match(dt)
+        if match is None:
+            return parse_datetime(dt).strftime(OUTPUT_TIME_FORMAT)
+        year, month, day, hour, minute, second = (int(part or 0) for part in match.groups())
+        return datetime(year, month, day, hour, minute, second).strftime(OUTPUT_TIME_FORMAT)
+
+    if isinstance(dt, datetime):
+        return dt.strftime(OUTPUT_TIME_FORMAT)
+
+
+def fast_deserialize_json_for_postgres(source):
+    """
+    deserialize_json_for_postgres that decodes plain JSON objects with json.loads
+    and falls back to ast.literal_eval only where the two could disagree.
+    """
+    if isinstance(source, str) and not NON_PYTHON_JSON_PATTERN.search(source):
+        try:
+            result = json.loads(source)
+        except ValueError:
+            result = None
+        if isinstance(result, dict):
+            return result
+    return deserialize_json_for_postgres(source)
+
+
+def _copy_decoded(value):
+    """
+    Copy the dicts and lists of a decoded JSON value, so rows do not share them.
+    """
+    if isinstance(value, dict):
+        return dict((key, _copy_decoded(element)) for key, element in value.items())
+    if isinstance(value, list):
+        return [_copy_decoded(element) for element in value]
+    return value
+
+
+def _decode_once(decoded, source, decoder):
+    """
+    Decode every distinct string only once per batch; every row gets its own copy.
+    """
+    if not isinstance(source, str):
+        return decoder(source)
+    try:
+        result = decoded[source]
+    except KeyError:
+        result = decoded[source] = decoder(source)
+    return _copy_decoded(result)
+
+
+def reformat_vulnerabilities_for_output(items):
+    """
+    Batch version of reformat_vulnerability_for_output with the same output.
+    Every distinct JSON string is decoded once per call and every row gets
+    its own copy of the decoded dicts and lists.
+    """
+    postgres_json = {}
+    times = {}
+    cwe_lists = {}
+    cwe_id_lists = {}
+    capecs = {}
+    metadatas = {}
+    result = []
+    for item in items:
+        id_ = item.get("id", None)
+        if id_ is None:
+            result.append(None)
+            continue
+        access = item.get("access", None)
+        impact = item.get("impact", None)
+        capec_list = item.get("capec_elements", [])
+        result.append(dict(
+            _id=id_,
+            Published=_decode_once(times, item.get("publushed", datetime.utcnow()), fast_unify_time),
+            Modified=_decode_once(times, item.get("modified", datetime.utcnow()), fast_unify_time),
+            access=_decode_once(postgres_json, access, fast_deserialize_json_for_postgres)
+            if isinstance(access, str) else make_access(access),
+            impact=_decode_once(postgres_json, impact, fast_deserialize_json_for_postgres)
+            if isinstance(impact, str) else make_impact(impact),
+            cvss_time=_decode_once(times, item.get("cvss_time", datetime.utcnow()), fast_unify_time),
+            cvss=item.get("cvss", 0.0),
+            cwe=_decode_once(cwe_lists, item.get("cwe_elements", []), make_cwe_list),
+            cwe_id=_decode_once(cwe_id_lists, item.get("cwe", []), make_cwe_id_list),
+            title=item.get("vulnerability_id", ""),
+            description=item.get("description", ""),
+            rank=floor(float(item.get("cvss", 0.0))),
+            __v=0,
+            capec=[_decode_once(capecs, capec, convert_capec) for capec in capec_list],
+            vulnerable_configurations=[],
+            vulnerable_configuration=item.get("vulnerable_configuration", []),
+            cve_references=item.get("references", []),
+            vector_string=item.get("vector_string", ""),
+            metadata=_decode_once(metadatas, item.get("metadata", {
+                "npm": [],
+                "snyk": [],
+                "ms": [],
+                "hacker_news": []
+            }), make_metadata)
+        ))
+    return result
+
+
 def fill_json_structure_for_api_ui(content_for_search, one_search_result):
     return dict(
         project_id=content_for_search["project_id"],
@@ -232,7 +357,142 @@ def deserialize_json_for_postgres(source):
     return json.loads(a)
 
 
-def get_file(getfile, unpack=True, raw=False, HTTP_PROXY=None):
+def make_conditional_headers(etag=None, last_modified=None):
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    return headers
+
+
+def spool_response(response, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """
+    Copy response body (urllib or requests) to an anonymous temp file chunk by chunk and rewind it.
+    The sha256 of the downloaded bytes is computed on the way and set as response.sha256.
+    """
+    if hasattr(response, 'iter_content'):
+        chunks = response.iter_content(chunk_size)
+    else:
+        chunks = iter(partial(response.read, chunk_size), b'')
+    digest = hashlib.sha256()
+    spool = tempfile.TemporaryFile()
+    try:
+        for chunk in chunks:
+            digest.update(chunk)
+            spool.write(chunk)
+    except Exception:
+        spool.close()
+        raise
+    spool.seek(0)
+    response.sha256 = digest.hexdigest()
+    return spool
+
+
+def open_spooled_response(response, unpack=True, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """
+    Spool response to disk and return a file-like object that
+    decompresses gzip, bzip2 and zip payloads incrementally on read.
+    """
+    spool = spool_response(response, chunk_size)
+    return open_spooled_file(spool, response.info().get('Content-Type') or '', unpack)
+
+
+def open_spooled_file(spool, content_type, unpack=True):
+    """
+    Wrap a spooled download into an incremental decompressor chosen by its Content-Type.
+    """
+    if not unpack:
+        return spool
+    if 'gzip' in content_type:
+        return gzip.GzipFile(fileobj=spool)
+    elif 'bzip2' in content_type:
+        return bz2.BZ2File(spool)
+    elif 'zip' in content_type:
+        fzip = zipfile.ZipFile(spool, 'r')
+        if len(fzip.namelist()) > 0:
+            return fzip.open(fzip.namelist()[0])
+    return spool
+
+
+ZIP_LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+ZIP_LOCAL_SIGNATURE = b'PK\x03\x04'
+
+
+class StreamDecompressor(object):
+    """
+    Decompress a download chunk by chunk as it arrives, chosen by its Content-Type:
+    gzip, bzip2 and the first member of a zip archive (deflated or stored).
+    Other payloads pass through. Data after the end of the compressed
+    stream, such as the zip central directory, is ignored.
+    """
+
+    def __init__(self, content_type=''):
+        content_type = content_type or ''
+        self._decompressor = None
+        self._zip_header = None
+        self._remaining = None
+        if 'gzip' in content_type:
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif 'bzip2' in content_type:
+            self._decompressor = bz2.BZ2Decompressor()
+        elif 'zip' in content_type:
+            self._zip_header = b''
+
+    def _open_zip_member(self, chunk):
+        self._zip_header += chunk
+        if len(self._zip_header) < ZIP_LOCAL_HEADER.size:
+            return None
+        signature, _, flags, method, _, _, _, compressed_size, _, name_length, extra_length = \
+            ZIP_LOCAL_HEADER.unpack_from(self._zip_header)
+        if signature != ZIP_LOCAL_SIGNATURE:
+            raise ValueError('Not a zip archive')
+        start = ZIP_LOCAL_HEADER.size + name_length + extra_length
+        if len(self._zip_header) < start:
+            return None
+        if method == zipfile.ZIP_DEFLATED:
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        elif method == zipfile.ZIP_STORED and not flags & 0x08:
+            self._remaining = compressed_size
+        else:
+            raise ValueError('Unsupported zip member: method {0}, flags {1}'.format(method, flags))
+        chunk, self._zip_header = self._zip_header[start:], None
+        return chunk
+
+    def decompress(self, chunk):
+        if self._zip_header is not None:
+            chunk = self._open_zip_member(chunk)
+            if chunk is None:
+                return b''
+        if self._decompressor is not None:
+            if self._decompressor.eof:
+                return b''
+            return self._decompressor.decompress(chunk)
+        if self._remaining is not None:
+            chunk = chunk[:self._remaining]
+            self._remaining -= len(chunk)
+        return chunk
+
+
+DOWNLOAD_LISTENERS = []
+
+
+def report_download(url, online):
+    """
+    Tell the download listeners (e.g. downloads.connectivity.mark) whether the host of `url` answered.
+    """
+    for listener in DOWNLOAD_LISTENERS:
+        listener(url, online)
+
+
+def get_file(getfile, unpack=True, raw=False, HTTP_PROXY=None, headers=None, stream=False):
+    """
+    Download a source and unpack it.
+    Whether the host answered is passed to report_download.
+    With `stream` the payload is spooled to a unique temp file and the
+    returned data is a file-like object that is decompressed on read;
+    response.sha256 is then the digest of the downloaded bytes.
+    """
     if platform.system().lower() == "linux":
         try:
             if HTTP_PROXY:
@@ -241,21 +501,19 @@ def get_file(getfile, unpack=True, raw=False, HTTP_PROXY=None):
                 opener = req.build_opener(proxy, auth, req.HTTPHandler)
                 req.install_opener(opener)
 
-            data = response = req.urlopen(getfile)
+            data = response = req.urlopen(req.Request(getfile, headers=headers or {}))
+            report_download(getfile, True)
 
             if raw:
                 return data
 
+            if stream:
+                return open_spooled_response(response, unpack), response
+
             if unpack:
                 if 'gzip' in response.info().get('Content-Type'):
-                    current_directory = os.path.dirname(os.path.abspath(__file__))
-                    tmp_file = "data.json"
-                    full_path = "".join([
-                        current_directory, "/", tmp_file
-                    ])
-                    with open(full_path, "wb") as outfile:
-                        outfile.write(gzip.decompress(response.read()))
-                    out = open(full_path, 'r').read()
+                    with open_spooled_response(response) as unpacked:
+                        out = unpacked.read().decode('utf-8')
                     return out, response
                 elif 'bzip2' in response.info().get('Content-Type'):
                     data = BytesIO(bz2.decompress(response.read()))
@@ -265,6 +523,14 @@ def get_file(getfile, unpack=True, raw=False, HTTP_PROXY=None):
                     if length_of_namelist > 0:
                         data = BytesIO(fzip.read(fzip.namelist()[0]))
             return data, response
+        except req.HTTPError as ex:
+            report_download(getfile, True)
+            if ex.code == 304:
+                return None, NOT_MODIFIED
+            return None, str(ex)
+        except OSError as ex:
+            report_download(getfile, False)
+            return None, str(ex)
         except Exception as ex:
             return None, str(ex)
 
@@ -276,11 +542,15 @@ def get_file(getfile, unpack=True, raw=False, HTTP_PROXY=None):
                 opener = req.build_opener(proxy, auth, req.HTTPHandler)
                 req.install_opener(opener)
 
-            data = response = req.urlopen(getfile)
+            data = response = req.urlopen(req.Request(getfile, headers=headers or {}))
+            report_download(getfile, True)
 
             if raw:
                 return data
 
+            if stream:
+                return open_spooled_response(response, unpack), response
+
             if unpack:
                 if 'gzip' in response.info().get('Content-Type'):
                     buf = BytesIO(response.read())
@@ -293,49 +563,176 @@ def get_file(getfile, unpack=True, raw=False, HTTP_PROXY=None):
                     if length_of_namelist > 0:
                         data = BytesIO(fzip.read(fzip.namelist()[0]))
             return data, response
+        except req.HTTPError as ex:
+            report_download(getfile, True)
+            if ex.code == 304:
+                return None, NOT_MODIFIED
+            return None, str(ex)
+        except OSError as ex:
+            report_download(getfile, False)
+            return None, str(ex)
         except Exception as ex:
             return None, str(ex)
 
 
+CVE_ROW_FIELDS = dict(
+    (name, member.value + 1)
+    for name, member in ExtendedCVEItemIndexes.__members__.items()
+    if name != 'length')
+CVE_ROW_FIELDS['id'] = 0
+
+# JSON key -> row field. The keys are those of the old tuple_to_json, which read
+# CVEItemIndexes.componentversion and capec; neither exists in the row layout.
+# componentversion is filled from component_version_string (the version range
+# as one string), capec has no column and is always None.
+CVE_ROW_JSON_KEYS = (
+    ('id', 'id'),
+    ('vulnerability_id', 'cve_id'),
+    ('componentversion', 'component_version_string'),
+    ('cwe', 'cwe'),
+    ('capec', None),
+    ('references', 'references'),
+    ('vulnerable_configuration', 'vulnerable_configuration'),
+    ('data_type', 'data_type'),
+    ('data_version', 'data_version'),
+    ('data_format', 'data_format'),
+    ('description', 'description'),
+    ('published', 'published'),
+    ('modified', 'modified'),
+    ('access', 'access'),
+    ('impact', 'impact'),
+    ('vector_string', 'cvss_vector'),
+    ('cvss_time', 'cvss_time'),
+    ('cvss', 'cvss'),
+)
+CVE_ROW_JSON_FIELDS = dict(CVE_ROW_JSON_KEYS)
+
+
+class CVERow(Mapping):
+    """
+    Read-only view of one search result tuple laid out as (id, *ExtendedCVEItemIndexes).
+    Holds only a reference to the tuple; fields are read by name or key
+    and the dict is built by to_json only when the row is returned.
+    Fields missing from a short (CVEItemIndexes) tuple read as None.
+    """
+
+    __slots__ = ('item', )
+
+    def __init__(self, item):
+        self.item = item
+
+    def __getattr__(self, name):
+        try:
+            index = CVE_ROW_FIELDS[name]
+        except KeyError:
+            raise AttributeError(name)
+        return self.item[index] if index < len(self.item) else None
+
+    def __getitem__(self, key):
+        name = CVE_ROW_JSON_FIELDS[key]
+        return None if name is None else getattr(self, name)
+
+    def __iter__(self):
+        return (json_key for json_key, _ in CVE_ROW_JSON_KEYS)
+
+    def __len__(self):
+        return len(CVE_ROW_JSON_KEYS)
+
+    def __repr__(self):
+        return 'CVERow({0!r})'.format(self.item)
+
+    def to_json(self):
+        return dict((json_key, None if name is None else getattr(self, name)) for json_key, name in CVE_ROW_JSON_KEYS)
+
+
 def tuple_to_json(src):
-    item = list(src)
-    return dict(
-        id=item[0],
-        vulnerability_id=item[CVEItemIndexes.cve_id.value + 1],
-        componentversion=item[CVEItemIndexes.componentversion.value + 1],
-        cwe=item[CVEItemIndexes.cwe.value + 1],
-        capec=item[CVEItemIndexes.capec.value + 1],
-        references=item[CVEItemIndexes.references.value + 1],
-        vulnerable_configuration=item[CVEItemIndexes.vulnerable_configuration.value + 1],
-        data_type=item[CVEItemIndexes.data_type.value + 1],
-        data_version=item[CVEItemIndexes.data_version.value + 1],
-        data_format=item[CVEItemIndexes.data_format.value + 1],
-        description=item[CVEItemIndexes.description.value + 1],
-        published=item[CVEItemIndexes.published.value + 1],
-        modified=item[CVEItemIndexes.modified.value + 1],
-        access=item[CVEItemIndexes.access.value + 1],
-        impact=item[CVEItemIndexes.impact.value + 1],
-        vector_string=item[CVEItemIndexes.cvss_vector.value + 1],
-        cvss_time=item[CVEItemIndexes.cvss_time.value + 1],
-        cvss=item[CVEItemIndexes.cvss.value + 1],
-    )
+    return CVERow(src).to_json()
+
+
+def convert_search_result_to_rows(elements: list):
+    """
+    Wrap search result tuples into CVERow views without copying them.
+    Call to_json on the rows that are actually returned.
+    """
+    if isinstance(elements, tuple):
+        return [CVERow(elements)]
+    if isinstance(elements, list):
+        return [CVERow(element) for element in elements]
+    return []
 
 
 def convert_search_result_from_tuple_to_json(elements: list):
-    found_items = []
+    return [row.to_json() for row in convert_search_result_to_rows(elements)]
 
-    if isinstance(elements, tuple):
-        found_items.append(
-            tuple_to_json(elements)
-        )
-    elif isinstance(elements, list):
-        for element in elements:
-            found_items.append(
-                tuple_to_json(
-                    element
-                )
-            )
-    return found_items
+
+_FROZEN_DICT = object()
+_FROZEN_LIST = object()
+_FROZEN_TUPLE = object()
+_FROZEN_SET = object()
+
+
+def canonical_key(element):
+    """
+    Hashable key with the equality of `element`; dicts, lists and sets are
+    frozen recursively, so e.g. reference dicts can be indexed.
+    """
+    try:
+        hash(element)
+        return element
+    except TypeError:
+        pass
+    if isinstance(element, dict):
+        return _FROZEN_DICT, frozenset((key, canonical_key(value)) for key, value in element.items())
+    if isinstance(element, list):
+        return _FROZEN_LIST, tuple(canonical_key(value) for value in element)
+    if isinstance(element, tuple):
+        return _FROZEN_TUPLE, tuple(canonical_key(value) for value in element)
+    if isinstance(element, (set, frozenset)):
+        return _FROZEN_SET, frozenset(canonical_key(value) for value in element)
+    return type(element), repr(element)
+
+
+class UniqueListMerger(object):
+    """
+    Order-preserving merge into `target_list` backed by a hash index of canonical keys.
+    Keep one merger while merging many sources into the same list,
+    so the index is built only once.
+    """
+
+    def __init__(self, target_list=None):
+        self.target_list = target_list if target_list is not None else []
+        self.index = set(canonical_key(element) for element in self.target_list)
+
+    def add(self, element):
+        key = canonical_key(element)
+        if key in self.index:
+            return False
+        self.index.add(key)
+        self.target_list.append(element)
+        return True
+
+    def extend(self, src_list):
+        for element in src_list:
+            self.add(element)
+        return self.target_list
+
+    def __contains__(self, element):
+        return canonical_key(element) in self.index
+
+    def __len__(self):
+        return len(self.target_list)
+
+
+def merge_unique_lists(*src_lists, target_list=None):
+    """
+    Merge lists into `target_list` (a new list by default), skipping elements already
+    present; the first occurrence wins. Non-list sources are ignored.
+    """
+    merger = UniqueListMerger(target_list)
+    for src_list in src_lists:
+        if isinstance(src_list, list):
+            merger.extend(src_list)
+    return merger.target_list
 
 
 def append_element_if_not_in_target_list(element, target_list: list):
@@ -347,12 +744,22 @@ def append_element_if_not_in_target_list(element, target_list: list):
 
 def append_list_if_not_in_target_list(src_list: list, target_list: list):
     if isinstance(src_list, list) and isinstance(target_list, list):
-        for element in src_list:
-            if element not in target_list:
-                target_list.append(element)
+        merge_unique_lists(src_list, target_list=target_list)
     return target_list
 
 
+def chunked(iterable, size):
+    """
+    Split any iterable into lists of at most `size` elements without materializing it.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
 def check_internet_connection():
     url = 'http://www.google.com/'
     timeout = 5
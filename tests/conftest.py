@@ -0,0 +1,35 @@
+import os
+import sys
+
+import pytest
+
+srcDir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+sys.path.append(srcDir)
+sys.path.append(os.path.join(srcDir, 'plugins'))
+
+from dskcache import DequeDiskCache
+
+
+def close_cache(cache):
+    cache._cache.close()
+    if cache.key_index is not None:
+        cache.key_index.close()
+    if cache._groups_state is not None:
+        cache._groups_state.close()
+
+
+@pytest.fixture
+def make_cache(tmp_path):
+    """
+    Factory of DequeDiskCache instances in temporary directories, closed after the test.
+    """
+    caches = []
+
+    def make(**kwargs):
+        cache = DequeDiskCache(directory=str(tmp_path / 'cache{0}'.format(len(caches))), **kwargs)
+        caches.append(cache)
+        return cache
+
+    yield make
+    for cache in caches:
+        close_cache(cache)
@@ -0,0 +1,20 @@
+from playhouse.pool import PooledSqliteDatabase
+
+from databases import init_databases, connection
+from models.model_cwe import cwe_db_proxy
+
+
+def test_connection_reuses_the_pooled_connection(tmp_path):
+    database = init_databases(PooledSqliteDatabase(str(tmp_path / 'cwe.db'), max_connections=2))
+    try:
+        assert cwe_db_proxy.obj is database
+        with connection():
+            first = database.connection()
+            with connection():
+                assert database.connection() is first
+            assert not database.is_closed()
+        assert database.is_closed()
+        with connection():
+            assert database.connection() is first
+    finally:
+        database.close_all()
@@ -0,0 +1,108 @@
+import gzip
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from downloads import Downloader, ConnectivityOracle
+
+BODY = b'<Weakness_Catalog/>' * 100
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    """
+    Serves the responses queued in server.script, then BODY gzipped.
+    """
+
+    def do_GET(self):
+        self.server.requests += 1
+        step = self.server.script.pop(0) if self.server.script else 'ok'
+        payload = gzip.compress(BODY, mtime=0)
+        if step == '503':
+            self.send_error(503)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-gzip')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        if step == 'truncated':
+            self.wfile.write(payload[:len(payload) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FlakyHandler)
+    server.script = []
+    server.requests = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_url(server):
+    return 'http://127.0.0.1:{0}/cwec.xml.gz'.format(server.server_address[1])
+
+
+def make_downloader(retry_count):
+    return Downloader(retry_count=retry_count, retry_timeout=0.01, backoff_base=0.01, timeout=5)
+
+
+def test_fetch_retries_after_503(server):
+    server.script = ['503']
+    with make_downloader(retry_count=2) as downloader:
+        data, response = downloader.fetch(make_url(server))
+    assert data.read() == BODY
+    assert response.status_code == 200
+    assert response.sha256 == hashlib.sha256(gzip.compress(BODY, mtime=0)).hexdigest()
+    assert server.requests == 2
+
+
+def test_fetch_retries_a_broken_body(server):
+    server.script = ['truncated', '503']
+    with make_downloader(retry_count=2) as downloader:
+        results = downloader.fetch_all(dict(cwe=make_url(server)))
+    data, _ = results['cwe']
+    assert data.read() == BODY
+    assert server.requests == 3
+
+
+def test_fetch_gives_up_after_retry_count(server):
+    server.script = ['503'] * 5
+    with make_downloader(retry_count=1) as downloader:
+        data, error = downloader.fetch(make_url(server))
+    assert data is None and '503' in error
+    assert server.requests == 2
+
+
+def test_refresh_of_one_host_does_not_hold_back_another():
+    release = threading.Event()
+    probed = []
+
+    class BlockingOracle(ConnectivityOracle):
+        def probe(self, host):
+            probed.append(host)
+            if host[0] == 'a.example':
+                release.wait(5)
+            return True
+
+    oracle = BlockingOracle(urls=['http://a.example/', 'http://b.example/'])
+    try:
+        oracle.refresh_async([('a.example', 80)])
+        oracle.refresh_async([('a.example', 80), ('b.example', 80)])
+        for _ in range(100):
+            if oracle._status.get(('b.example', 80)):
+                break
+            release.wait(0.01)
+        assert oracle._status[('b.example', 80)][0] is True
+        assert probed.count(('a.example', 80)) == 1
+    finally:
+        release.set()
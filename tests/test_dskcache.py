@@ -0,0 +1,47 @@
+import pytest
+
+from dskcodecs import loads_value
+
+
+def test_raw_values_starting_with_digits(make_cache):
+    cache = make_cache()
+    cache.extend([b'0123', b'1abc'], compressed=False)
+    cache.append({'id': 1})
+    assert cache.popleft() == b'0123'
+    assert cache.popleft() == b'1abc'
+    assert loads_value(cache.popleft(compressed=False)) == {'id': 1}
+
+
+def test_index_survives_drain_and_refill(make_cache):
+    cache = make_cache(index_key=lambda item: item['id'])
+    cache.append({'id': 'A'})
+    assert cache.popleft() is not None
+    cache.append({'id': 'B'})
+    assert not cache.contains({'id': 'A'})
+    assert cache.get_by_key('A') is None
+    assert cache.count({'id': 'A'}) == 0
+    with pytest.raises(ValueError):
+        cache.remove({'id': 'A'})
+    assert len(cache) == 1 and cache.contains({'id': 'B'})
+    cache.extend([{'id': 'C'}, {'id': 'B'}])
+    assert cache.count({'id': 'B'}) == 2
+    assert cache.index({'id': 'C'}, 0, len(cache)) == 1
+
+
+def test_insert_respects_reject_new(make_cache):
+    cache = make_cache(max_items=2, eviction_policy='reject-new')
+    cache.extend([{'id': 1}, {'id': 2}])
+    cache.insert(1, {'id': 3})
+    assert [item['id'] for item in map(loads_value, cache.popleft_many(10, compressed=False))] == [1, 2]
+    assert cache.stats()['rejected'] == 1
+
+
+def test_spilled_archive_is_rotated(make_cache):
+    cache = make_cache(max_items=1, eviction_policy='spill-to-archive', low_watermark=0.5,
+                       max_archive_bytes=64)
+    for i in range(20):
+        cache.append({'id': i, 'pad': 'x' * 16})
+    assert cache.stats()['spilled'] == 20 - len(cache)
+    assert cache.archive_bytes() <= 2 * 64
+    spilled = [loads_value(value)['id'] for value in cache.iter_archive(compressed=False)]
+    assert spilled == list(range(spilled[0], 20 - len(cache)))
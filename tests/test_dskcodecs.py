@@ -0,0 +1,14 @@
+import pytest
+
+from dskcodecs import encode_value, decode_value, loads_value
+
+
+@pytest.mark.parametrize('raw', [b'0123', b'1abc', b'6', b'\x10\x11', b'x not zlib', b'{"a": 1}'])
+def test_raw_values_are_not_decoded(raw):
+    assert decode_value(raw) == raw
+    assert loads_value(raw) == raw
+
+
+@pytest.mark.parametrize('value', [{'id': 1}, 'text', b'bytes'])
+def test_encoded_values_roundtrip(value):
+    assert loads_value(encode_value(value, 'zlib')) == value
@@ -0,0 +1,35 @@
+from dskcodecs import loads_value
+from dskgroups import ConsumerGroup
+
+
+def claim_ids(group, n=10):
+    claimed = group.claim(n, compressed=False)
+    return [sequence for sequence, _ in claimed], [loads_value(item)['id'] for _, item in claimed]
+
+
+def test_groups_survive_drain_and_refill(make_cache):
+    cache = make_cache()
+    group = ConsumerGroup(cache, 'test')
+    try:
+        cache.extend([{'id': i} for i in range(3)])
+        sequences, ids = claim_ids(group)
+        assert ids == [0, 1, 2]
+        assert group.ack(sequences) == 3
+        assert len(cache) == 0
+        cache.extend([{'id': i} for i in range(3, 5)])
+        assert group.lag() == 2
+        sequences, ids = claim_ids(group)
+        assert ids == [3, 4]
+    finally:
+        group.state.close()
+
+
+def test_no_eviction_while_groups_are_registered(make_cache):
+    cache = make_cache(max_items=2, eviction_policy='drop-oldest')
+    group = ConsumerGroup(cache, 'test')
+    try:
+        cache.extend([{'id': i} for i in range(4)])
+        assert len(cache) == 4
+        assert claim_ids(group)[1] == [0, 1, 2, 3]
+    finally:
+        group.state.close()
@@ -0,0 +1,31 @@
+import pytest
+
+from dskcodecs import loads_value
+from dsklog import SegmentLogCache
+
+
+def test_rewind_survives_reload(tmp_path):
+    directory = str(tmp_path)
+    log = SegmentLogCache(directory=directory, compact_interval=0)
+    log.extend([{'id': i} for i in range(5)])
+    assert len(log.popleft_many(2)) == 2
+    values = log.popleft_many(2, compressed=False)
+    log.extendleft(reversed(values), compressed=False)
+    with pytest.raises(ValueError):
+        log.extendleft([b'other', b'values'], compressed=False)
+    log.close()
+    log = SegmentLogCache(directory=directory, compact_interval=0)
+    try:
+        assert [loads_value(value)['id'] for value in log.popleft_many(10, compressed=False)] == [2, 3, 4]
+    finally:
+        log.close()
+
+
+def test_popleft_blobs_are_views(tmp_path):
+    log = SegmentLogCache(directory=str(tmp_path), compact_interval=0)
+    try:
+        log.extend([{'id': 5}])
+        blobs = log.popleft_blobs(1)
+        assert isinstance(blobs[0], memoryview) and loads_value(blobs[0]) == {'id': 5}
+    finally:
+        log.close()
@@ -0,0 +1,28 @@
+import json
+
+from utils import reformat_vulnerability_for_output, reformat_vulnerabilities_for_output
+from benchmarks.bench_formatter import make_rows
+
+
+def test_batch_output_is_byte_identical():
+    rows = make_rows(2000)
+    expected = [reformat_vulnerability_for_output(row) for row in rows]
+    actual = reformat_vulnerabilities_for_output(rows)
+    assert len(actual) == len(expected)
+    for one, other in zip(expected, actual):
+        assert json.dumps(one) == json.dumps(other)
+
+
+def test_rows_of_one_batch_do_not_share_decoded_values():
+    row = make_rows(1)[0]
+    row.update(
+        access='{"vector": "NETWORK", "complexity": "LOW", "authentication": "NONE"}',
+        impact='{"confidentiality": "PARTIAL", "integrity": "NONE", "availability": "NONE"}',
+        cwe_elements=json.dumps(json.dumps(['CWE-79'])),
+        metadata='{"npm": ["lodash"]}')
+    first, second = reformat_vulnerabilities_for_output([row, dict(row)])
+    first['access']['vector'] = 'LOCAL'
+    first['impact']['integrity'] = 'COMPLETE'
+    first['cwe'].append('CWE-89')
+    first['metadata']['npm'].append('left-pad')
+    assert second == reformat_vulnerability_for_output(row)
@@ -0,0 +1,35 @@
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from plg_cwe_updater import make_metrics_server
+
+
+class StaticMetrics(object):
+
+    def to_prometheus(self):
+        return 'cwe_updater_records_total 3\n'
+
+
+@pytest.fixture
+def metrics_server():
+    server = make_metrics_server(StaticMetrics(), port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_metrics_server_listens_on_loopback(metrics_server):
+    assert metrics_server.server_address[0] == '127.0.0.1'
+
+
+def test_metrics_endpoint(metrics_server):
+    base = 'http://127.0.0.1:{0}'.format(metrics_server.server_address[1])
+    with urllib.request.urlopen(base + '/metrics') as response:
+        assert response.read() == b'cwe_updater_records_total 3\n'
+    with pytest.raises(urllib.error.HTTPError) as error:
+        urllib.request.urlopen(base + '/other')
+    assert error.value.code == 404
@@ -0,0 +1,47 @@
+import json
+
+import pytest
+
+from utils import (ExtendedCVEItemIndexes, CVEItemIndexes, CVERow, CVE_ROW_JSON_KEYS,
+                   convert_search_result_to_rows, convert_search_result_from_tuple_to_json)
+
+ROW_LENGTH = ExtendedCVEItemIndexes.length.value + 2
+
+
+def make_row(i):
+    return (i, 'CVE-2018-{0:05d}'.format(i)) + tuple('field {0}'.format(j) for j in range(ROW_LENGTH - 2))
+
+
+def column(row, member):
+    return row[member.value + 1]
+
+
+def test_row_reads_fields_by_name_and_key():
+    row = make_row(7)
+    view = CVERow(row)
+    assert view.id == 7
+    assert view['vulnerability_id'] == 'CVE-2018-00007'
+    assert view['componentversion'] == column(row, ExtendedCVEItemIndexes.component_version_string)
+    assert view['cvss'] == column(row, ExtendedCVEItemIndexes.cvss)
+    assert view.ms_list == column(row, ExtendedCVEItemIndexes.ms_list)
+    assert view['capec'] is None
+    with pytest.raises(AttributeError):
+        view.no_such_field
+
+
+def test_short_rows_read_missing_fields_as_none():
+    row = (1, ) + tuple('field {0}'.format(j) for j in range(len(CVEItemIndexes)))
+    view = CVERow(row)
+    assert view['cvss'] == column(row, CVEItemIndexes.cvss)
+    assert view['componentversion'] is None
+
+
+def test_convert_search_result_returns_json_dicts():
+    rows = [make_row(i) for i in range(3)]
+    result = convert_search_result_from_tuple_to_json(rows)
+    assert all(type(item) is dict for item in result)
+    assert [list(item) for item in result] == [[key for key, _ in CVE_ROW_JSON_KEYS]] * 3
+    assert json.loads(json.dumps(result)) == result
+    assert result == [row.to_json() for row in convert_search_result_to_rows(rows)]
+    assert convert_search_result_from_tuple_to_json(rows[0]) == result[:1]
+    assert convert_search_result_from_tuple_to_json(None) == []